@@ -0,0 +1,56 @@
+/* Clientside callbacks of the year slider (SOLAR_CLIENTSIDE_YEAR=1), the yearly values of the
+   selected layer being stored once in the year-matrix store */
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    solar: {
+        /* Recolor the map for the selected year, the geometry of the figure is kept as is */
+        recolor_map: function (year, matrix, metric, figure) {
+            if (!matrix || !figure || metric === "potential") {
+                return window.dash_clientside.no_update;
+            }
+
+            const row = matrix.years.indexOf(year);
+            const power = matrix.power[row];
+
+            let z = power;
+            let coloraxis = figure.layout.coloraxis;
+
+            if (metric === "ratio") {
+                z = power.map(function (value, i) {
+                    const ratio = 100 * value / matrix.potential[i];
+                    return Number.isFinite(ratio) ? ratio : null;
+                });
+                coloraxis = Object.assign({}, coloraxis, {colorscale: matrix.ratio_colorscales[row]});
+            }
+
+            return Object.assign({}, figure, {
+                data: [Object.assign({}, figure.data[0], {z: z})].concat(figure.data.slice(1)),
+                layout: Object.assign({}, figure.layout, {coloraxis: coloraxis}),
+            });
+        },
+
+        /* Share of the deployed capacity of each unit for the selected year */
+        update_share: function (year, matrix, figure) {
+            if (!matrix || !figure) {
+                return window.dash_clientside.no_update;
+            }
+
+            const power = matrix.power[matrix.years.indexOf(year)];
+            const total = power.reduce(function (sum, value) {
+                return sum + (value || 0);
+            }, 0);
+
+            return Object.assign({}, figure, {
+                data: [Object.assign({}, figure.data[0], {
+                    y: power.map(function (value) {
+                        return value === null ? null : value / total * 100;
+                    }),
+                })],
+                layout: Object.assign({}, figure.layout, {
+                    title: Object.assign({}, figure.layout.title, {
+                        text: "Répartition de la capacité photovoltaïque déployée en " + year,
+                    }),
+                }),
+            });
+        },
+    },
+});
@@ -1,9 +1,17 @@
+import functools
+import json
+import os
+import time
+
 import pandas as pd
 import pickle
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyproj
 
-from sqlalchemy import create_engine, select, func
-from sqlalchemy.orm import Session
+from sqlalchemy import create_engine, select, func, text
+from sqlalchemy.engine import make_url
 from sqlalchemy import Table, MetaData
 
 dbname = "QBuildings-Geneva"
@@ -12,44 +20,249 @@ password = "password"
 host = "128.179.39.7"
 port = "4443"
 
-engine = create_engine(f"postgresql+psycopg2://{user}:{password}@{host}:{port}/{dbname}")
+# Another database (e.g. a local PostgreSQL stand-in) can be used by setting SOLAR_DB_URL
+database_url = os.environ.get("SOLAR_DB_URL", f"postgresql+psycopg2://{user}:{password}@{host}:{port}/{dbname}")
+
+# Connections are kept open between queries and checked before use, the server closing idle ones
+pool_settings = {"pool_size": 2, "max_overflow": 2, "pool_pre_ping": True, "pool_recycle": 1800}
+
+engine = create_engine(
+    database_url, **(pool_settings if make_url(database_url).get_backend_name() == "postgresql" else {})
+)
+
+# Snapshot of the aggregates per girec cached locally, the database only being queried once it expired
+snapshot_path = os.environ.get("SOLAR_DB_SNAPSHOT", "data/qbuildings/snapshot.pickle")
+snapshot_ttl = 24 * 3600  # [s]
+
+# Materialized view of the aggregates on the server (requires the rights to create it)
+snapshot_view = "girec_snapshot"
+
+# Incremental sync of the potential: the buildings updated since the watermark (last update time seen) are pulled
+# and applied as deltas to the aggregates, the manifest recording when each girec was last refreshed
+sync_state_path = "data/qbuildings/sync_state.pickle"
+sync_manifest_path = "data/qbuildings/sync_manifest.json"
+sync_watermark_column = "updated_at"
+
+# Building-level export, streamed from a server-side cursor into the row groups of a GeoParquet file
+buildings_path = "data/qbuildings/buildings.parquet"
+buildings_crs = "EPSG:2056"
+buildings_schema = pa.schema([
+    ("id", pa.int64()),
+    ("geo_girec", pa.string()),
+    ("area_roof_solar_m2", pa.float64()),
+    ("geometry", pa.binary()),  # WKB
+])
+
+
+@functools.lru_cache(maxsize=None)
+def reflect(name, columns):
+    # Table of the "Processed" schema reflected once per process, limited to the columns used
+    metadata = MetaData(schema="Processed")
+
+    return Table(name, metadata, schema="Processed", autoload_with=engine, include_columns=list(columns))
+
+
+def snapshot_query():
+    # Building count, solar roof area and potential per girec, in a single pass over the buildings
+    girec = reflect("geo_girec", ("id",))
+    buildings = reflect("buildings", ("geo_girec", "geometry", "area_roof_solar_m2"))
+
+    return (
+        select(
+            girec.c.id.label("NOM"),
+            func.count(buildings.c.geometry).label("buildings_count"),
+            func.coalesce(func.sum(buildings.c.area_roof_solar_m2), 0).label("area_roof_solar"),
+        )
+        .select_from(girec.outerjoin(buildings, girec.c.id == buildings.c.geo_girec))
+        .group_by(girec.c.id)
+    )
+
+
+def refresh_snapshot_view():
+    # Create the materialized view of the snapshot query on the server (PostgreSQL) if needed, then refresh it
+    query = snapshot_query().compile(engine, compile_kwargs={"literal_binds": True})
+
+    with engine.begin() as connection:
+        connection.execute(text(f'CREATE MATERIALIZED VIEW IF NOT EXISTS "Processed".{snapshot_view} AS {query}'))
+        connection.execute(text(f'REFRESH MATERIALIZED VIEW "Processed".{snapshot_view}'))
+
+
+def return_snapshot(max_age=snapshot_ttl, use_view=False):
+    # Aggregates per girec (NOM): buildings_count, area_roof_solar and pv_potential, from the local cache if it
+    # is younger than max_age [s], otherwise from the database (from the materialized view with use_view)
+    if os.path.exists(snapshot_path):
+        with open(snapshot_path, 'rb') as f:
+            cached = pickle.load(f)
+
+        if time.time() - cached["time"] < max_age:
+            return cached["snapshot"]
+
+    if use_view:
+        query = text(f'SELECT * FROM "Processed".{snapshot_view}')
+    else:
+        query = snapshot_query()
+
+    with engine.connect() as connection:
+        df = pd.read_sql(query, connection).set_index("NOM")
+
+    # Round the values to zero decimal places
+    df["pv_potential"] = df["area_roof_solar"].round(0) * 0.2
+
+    os.makedirs(os.path.dirname(snapshot_path) or ".", exist_ok=True)
+    with open(snapshot_path, 'wb') as f:
+        pickle.dump({"time": time.time(), "snapshot": df}, f)
+
+    return df
 
 
 def return_buildings_count():
-    # Query to get the number of buildings per district
-    query = """
-        SELECT g.id AS district_name, COUNT(b.geometry) AS buildings_count
-        FROM "Processed".geo_girec g
-        LEFT JOIN "Processed".buildings b ON g.id = b.geo_girec
-        GROUP BY g.id
-        ORDER BY buildings_count DESC;
-        """
-
-    # Execute the query and fetch the results into a DataFrame
-    df = pd.read_sql(query, engine)
-    df.set_index('district_name', inplace=True)
+    # Number of buildings per district
+    df = return_snapshot()[["buildings_count"]].sort_values("buildings_count", ascending=False)
+    df.index.names = ['district_name']
 
     return df
 
 
 def return_solar_potential():
-    # Define the metadata and table, including the schema
-    metadata = MetaData(schema="Processed")
-    buildings = Table("buildings", metadata, schema="Processed", autoload_with=engine)
-
-    # Start a session
-    with Session(engine) as session:
-        # Create the query
-        stmt = (
-            select(buildings.c.geo_girec, func.sum(buildings.c.area_roof_solar_m2).label("area_roof_solar"))
-            .group_by(buildings.c.geo_girec)
+    df = return_snapshot()[["area_roof_solar", "pv_potential"]]
+
+    df.to_pickle("girec_potential.pickle")
+
+    return df
+
+
+def export_buildings(path=buildings_path, chunk_size=50000):
+    # Stream the buildings in chunks of rows (server-side cursor), each written as a row group of the file,
+    # so that the memory stays bounded by the chunk size whatever the size of the table
+    buildings = reflect("buildings", tuple(buildings_schema.names))
+
+    geometry = buildings.c.geometry
+    if engine.dialect.name == "postgresql":
+        geometry = func.ST_AsBinary(geometry)
+
+    query = select(buildings.c.id, buildings.c.geo_girec, buildings.c.area_roof_solar_m2, geometry.label("geometry"))
+
+    # GeoParquet metadata, the file can be read with geopandas.read_parquet
+    geo = {
+        "version": "1.0.0",
+        "primary_column": "geometry",
+        "columns": {"geometry": {"encoding": "WKB", "geometry_types": [], "crs": pyproj.CRS(buildings_crs).to_json_dict()}},
+    }
+    schema = buildings_schema.with_metadata({b"geo": json.dumps(geo).encode()})
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    rows = 0
+    start = time.perf_counter()
+
+    with engine.connect().execution_options(stream_results=True, max_row_buffer=chunk_size) as connection, \
+            pq.ParquetWriter(f"{path}.tmp", schema) as writer:
+        for chunk in pd.read_sql(query, connection, chunksize=chunk_size):
+            chunk["geometry"] = [None if value is None else bytes(value) for value in chunk["geometry"]]
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+
+            rows += len(chunk)
+            print(f"buildings : {rows} rows exported ({rows / (time.perf_counter() - start):.0f} rows/s)")
+
+    os.replace(f"{path}.tmp", path)
+
+    return rows
+
+
+def pull_buildings(watermark=None, chunk_size=50000):
+    # Girec, solar roof area and update time of the buildings updated since the watermark (all of them without),
+    # yielded chunk by chunk as they arrive from a server-side cursor
+    buildings = reflect("buildings", ("id", "geo_girec", "area_roof_solar_m2", sync_watermark_column))
+
+    # Reflection leaves out the columns that do not exist
+    if sync_watermark_column not in buildings.c:
+        raise ValueError(
+            f'"Processed".buildings has no {sync_watermark_column} column, the incremental sync needs the last '
+            "update time of every building (set sync_watermark_column to the column holding it)"
         )
 
-        # Execute the query and fetch all results
-        results = session.execute(stmt).all()
+    updated = buildings.c[sync_watermark_column]
+
+    query = select(buildings.c.id, buildings.c.geo_girec, buildings.c.area_roof_solar_m2, updated.label("updated"))
+    if watermark is not None:
+        # Rows of the watermark itself are pulled again, applying a row twice gives a zero delta
+        query = query.where(updated >= pd.Timestamp(watermark).to_pydatetime())
+
+    def chunks():
+        with engine.connect().execution_options(stream_results=True, max_row_buffer=chunk_size) as connection:
+            for chunk in pd.read_sql(query, connection, chunksize=chunk_size, parse_dates=["updated"]):
+                yield chunk.set_index("id")
+
+    return chunks()
+
+
+def sync_solar_potential(full=False):
+    # Potential per girec kept up to date from the buildings updated since the last sync. The state stores the
+    # girec and area of every building, so that a changed building moves its old area out of its old girec.
+    # Deleted buildings are not seen by the watermark, a full sync (full=True) is needed from time to time.
+    state = None
+    if not full and os.path.exists(sync_state_path):
+        state = pd.read_pickle(sync_state_path)
+
+    if state is None:
+        state = {
+            "buildings": pd.DataFrame({"geo_girec": pd.Series(dtype=object), "area_roof_solar_m2": pd.Series(dtype=float)}),
+            "aggregates": pd.Series(dtype=float, name="area_roof_solar"),
+            "watermark": None,
+        }
+        manifest = {"girecs": {}}
+    else:
+        with open(sync_manifest_path) as f:
+            manifest = json.load(f)
+
+    buildings = state["buildings"]
+    aggregates = state["aggregates"]
+    watermark = state["watermark"]
+
+    # Deltas of the aggregates applied chunk by chunk as the buildings are pulled: new areas added to the new
+    # girecs, previous ones removed from the previous girecs (a building is pulled once, so the previous state
+    # is that of the last sync). Only the girec and area of the pulled buildings are kept.
+    pulled = []
+    refreshed = set()
+    for changed in pull_buildings(state["watermark"]):
+        previous = buildings.reindex(changed.index).dropna(subset=["geo_girec"])
+        delta = (
+            changed.groupby("geo_girec")["area_roof_solar_m2"].sum()
+            .sub(previous.groupby("geo_girec")["area_roof_solar_m2"].sum(), fill_value=0)
+        )
+        aggregates = aggregates.add(delta, fill_value=0)
+        refreshed.update(delta.index)
+
+        pulled.append(changed[["geo_girec", "area_roof_solar_m2"]])
+        if len(changed):
+            watermark = changed["updated"].max() if watermark is None else max(watermark, changed["updated"].max())
+
+    aggregates = aggregates.rename("area_roof_solar")
+    if pulled:
+        changed_ids = pd.Index(np.concatenate([chunk.index.to_numpy() for chunk in pulled]))
+        buildings = pd.concat([buildings.drop(changed_ids, errors="ignore"), *pulled])
+
+    pulled_count = sum(len(chunk) for chunk in pulled)
+
+    now = pd.Timestamp.now().isoformat()
+    for girec in refreshed:
+        manifest["girecs"][girec] = now
+    manifest.update({
+        "synced_at": now,
+        "full": state["watermark"] is None,
+        "buildings_pulled": pulled_count,
+        "girecs_refreshed": len(refreshed),
+    })
+
+    manifest["watermark"] = None if watermark is None else pd.Timestamp(watermark).isoformat()
+
+    os.makedirs(os.path.dirname(sync_state_path) or ".", exist_ok=True)
+    pd.to_pickle({"buildings": buildings, "aggregates": aggregates, "watermark": watermark}, sync_state_path)
+    with open(sync_manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    print(f"sync : {pulled_count} buildings pulled, {len(refreshed)} girecs refreshed")
 
-    # Convert results to a DataFrame and set index to geo_girec
-    df = pd.DataFrame(results, columns=["geo_girec", "area_roof_solar"]).set_index("geo_girec")
+    df = aggregates.to_frame()
     df.index.names = ['NOM']
 
     # Round the values to zero decimal places
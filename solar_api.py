@@ -0,0 +1,250 @@
+import functools
+import hashlib
+import json
+
+import numpy as np
+import pandas as pd
+import shapely
+from flask import Response, request, stream_with_context
+
+import solar_cache
+import solar_cube
+
+# Read-only data API of the values shown by the app, served from the cube and geometry loaded by the app
+# workers so that other tools neither scrape the dashboard nor rerun the pipeline. Responses are streamed by
+# chunks of units (the finest grids have thousands of cells) and carry a weak ETag derived from the version
+# of the artifacts and code (solar_cache) and the request, a client revalidating with If-None-Match getting
+# a 304 until the next pipeline run or deploy.
+#
+#   GET /api/v1                                  granularities, models, years, metrics and potential scalings
+#   GET /api/v1/series/<granularity>/<model>     unit, year and the metrics of the units
+#         ?columns=power,ratio&start=2010&end=2030 (or year=2030)&units=A,B&potential=3&format=json|csv
+#   GET /api/v1/totals/<model>                   year, power and P10/P50/P90 of the canton (if simulated)
+#         ?columns=power&start=2010&end=2030&format=json|csv
+#   GET /api/v1/geojson/<granularity>            FeatureCollection of the units, the value of a metric in the
+#         ?tolerance=10&model=lin&year=2030&metric=power&potential=3    properties if a year is given
+
+chunk_units = 500  # Units per streamed chunk
+
+
+def _etag():
+    # Version of the artifacts and code, path and arguments of the request (in any order)
+    digest = hashlib.sha256(solar_cache.version.encode())
+    digest.update(request.path.encode())
+    digest.update(repr(sorted(request.args.items(multi=True))).encode())
+
+    return digest.hexdigest()[:16]
+
+
+def _error(status, message):
+    return Response(json.dumps({"error": message}), status=status, mimetype="application/json")
+
+
+def _endpoint(function):
+    # Conditional GET and errors of the endpoints: unknown names are 404, invalid arguments 400
+    @functools.wraps(function)
+    def wrapper(**kwargs):
+        etag = _etag()
+
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            try:
+                response = function(**kwargs)
+            except LookupError as error:
+                return _error(404, error.args[0])
+            except ValueError as error:
+                return _error(400, error.args[0])
+
+        # Weak: the body is the same whatever its encoding (flask_compress)
+        response.set_etag(etag, weak=True)
+        response.headers["Cache-Control"] = "no-cache"
+
+        return response
+
+    return wrapper
+
+
+def _name(value, names, kind):
+    if value not in names:
+        raise LookupError(f"Unknown {kind} {value!r}, expected one of {list(names)}")
+
+    return value
+
+
+def _integer(name, default=None):
+    value = request.args.get(name)
+    if value is None:
+        return default
+
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer, got {value!r}") from None
+
+
+def _choice(name, choices, default):
+    value = request.args.get(name, default)
+    if value not in choices:
+        raise ValueError(f"{name} must be one of {list(choices)}, got {value!r}")
+
+    return value
+
+
+def _columns(choices):
+    # Projection on some of the value columns, all of them by default
+    columns = [column for column in request.args.get("columns", "").split(",") if column] or list(choices)
+
+    unknown = [column for column in columns if column not in choices]
+    if unknown:
+        raise ValueError(f"Unknown columns {unknown}, expected some of {list(choices)}")
+
+    return columns
+
+
+def _years(years):
+    # Range of years of the request (start and end included, or a single year)
+    year = _integer("year")
+    start, end = (year, year) if year is not None else (_integer("start", years[0]), _integer("end", years[-1]))
+
+    selected = [year for year in years if start <= year <= end]
+    if not selected:
+        raise ValueError(f"No year between {start} and {end}, the years range from {years[0]} to {years[-1]}")
+
+    return selected
+
+
+def _potential_scaling():
+    return _choice("potential", [str(scaling) for scaling in solar_cube.potential_scalings], str(solar_cube.potential_scalings[0]))
+
+
+def _table(header, chunks, name):
+    # Streamed table: CSV with a header line or JSON in the split orientation of pandas ({"columns", "data"})
+    # chunks: DataFrames with the header as columns
+    if _choice("format", ["json", "csv"], "json") == "csv":
+        def body():
+            yield ",".join(header) + "\n"
+            for chunk in chunks:
+                yield chunk.to_csv(header=False, index=False)
+
+        response = Response(stream_with_context(body()), mimetype="text/csv")
+        response.headers["Content-Disposition"] = f'inline; filename="{name}.csv"'
+
+        return response
+
+    def body():
+        yield '{"columns": ' + json.dumps(header) + ', "data": ['
+        separator = ""
+        for chunk in chunks:
+            if len(chunk):
+                # Rows of the chunk without the brackets of the list, NaN as null
+                yield separator + chunk.to_json(orient="values")[1:-1]
+                separator = ", "
+        yield "]}"
+
+    return Response(stream_with_context(body()), mimetype="application/json")
+
+
+def register(server, cube, levels, bands, prefix="/api/v1"):
+    # Routes of the API on the Flask server of the app
+    # cube: values of the app (solar_cube), levels: {granularity: {tolerance: GeoSeries}} drawn by the app,
+    # bands: {model: P10/P50/P90 of the canton indexed by year}
+
+    @server.route(prefix)
+    @_endpoint
+    def api_index():
+        return Response(json.dumps({
+            "granularities": {
+                granularity: {"units": len(index), "tolerances": sorted(levels.get(granularity, {}))}
+                for granularity, index in cube["index"].items()
+            },
+            "models": cube["models"],
+            "years": solar_cube.years,
+            "metrics": solar_cube.metrics,
+            "potential_scalings": solar_cube.potential_scalings,
+        }), mimetype="application/json")
+
+    @server.route(f"{prefix}/series/<granularity>/<model>")
+    @_endpoint
+    def api_series(granularity, model):
+        index = cube["index"][_name(granularity, cube["index"], "granularity")]
+        model = _name(model, cube["models"], "model")
+        columns = _columns(solar_cube.metrics)
+        years = _years(solar_cube.years)
+        potential_scaling = int(_potential_scaling())
+
+        units = np.arange(len(index))
+        if request.args.get("units"):
+            names = request.args["units"].split(",")
+            units = index.get_indexer(names)
+            if (units < 0).any():
+                raise LookupError(f"Unknown units {[name for name, unit in zip(names, units) if unit < 0]} of {granularity}")
+
+        # Views of the cube (years x units) of each metric of the projection
+        rows = slice(years[0] - solar_cube.years[0], years[-1] - solar_cube.years[0] + 1)
+        values = {
+            metric: solar_cube.year_matrix(cube, granularity, model, potential_scaling, metric)[rows] for metric in columns
+        }
+
+        def chunks():
+            for start in range(0, len(units), chunk_units):
+                chunk = units[start:start + chunk_units]
+                frame = pd.DataFrame({
+                    "unit": np.repeat(index[chunk].to_numpy(), len(years)),
+                    "year": np.tile(years, len(chunk)),
+                })
+                for metric in columns:
+                    frame[metric] = values[metric][:, chunk].T.ravel()
+
+                yield frame
+
+        return _table(["unit", "year"] + columns, chunks(), f"{granularity}_{model}")
+
+    @server.route(f"{prefix}/totals/<model>")
+    @_endpoint
+    def api_totals(model):
+        model = _name(model, cube["models"], "model")
+        percentiles = list(bands[model].columns.intersection(["p10", "p50", "p90"])) if model in bands else []
+        columns = _columns(["power"] + percentiles)
+        years = _years(solar_cube.years)
+
+        frame = pd.DataFrame({"year": years, "power": solar_cube.totals(cube, "girec", model)[years].to_numpy()})
+        if percentiles:
+            frame = frame.join(bands[model][percentiles].reindex(years).reset_index(drop=True))
+
+        return _table(["year"] + columns, [frame[["year"] + columns]], f"totals_{model}")
+
+    @server.route(f"{prefix}/geojson/<granularity>")
+    @_endpoint
+    def api_geojson(granularity):
+        granularity_levels = levels[_name(granularity, levels, "granularity")]
+        tolerance = _integer("tolerance", min(granularity_levels))
+        geometry = granularity_levels[_name(tolerance, granularity_levels, "tolerance")]
+
+        # Value of a metric in the properties of the units if a year is given
+        values = None
+        if request.args.get("year") is not None:
+            model = _name(request.args.get("model", cube["models"][0]), cube["models"], "model")
+            metric = _choice("metric", solar_cube.metrics, "power")
+            year = _years(solar_cube.years)[0]
+            values = pd.Series(
+                solar_cube.lookup(cube, granularity, model, int(_potential_scaling()), metric, year), index=cube["index"][granularity]
+            ).reindex(geometry.index)
+
+        def body():
+            yield '{"type": "FeatureCollection", "features": ['
+            for start in range(0, len(geometry), chunk_units):
+                chunk = geometry.iloc[start:start + chunk_units]
+                features = []
+                for unit, feature_geometry in zip(chunk.index, shapely.to_geojson(chunk.values)):
+                    properties = {"id": unit}
+                    if values is not None:
+                        value = values[unit]
+                        properties["value"] = None if np.isnan(value) else float(value)
+                    features.append(f'{{"type": "Feature", "id": {json.dumps(unit)}, "properties": {json.dumps(properties)}, '
+                                    f'"geometry": {feature_geometry}}}')
+
+                yield (", " if start else "") + ", ".join(features)
+            yield "]}"
+
+        return Response(stream_with_context(body()), mimetype="application/geo+json")
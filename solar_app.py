@@ -1,18 +1,148 @@
-from dash import Dash, dcc, html, Input, Output
+import os
+
+from flask import has_request_context
+from flask_compress import Compress
+from dash import Dash, dcc, html, Input, Output, State, Patch, ctx, no_update, ClientsideFunction
 import dash_bootstrap_components as dbc
 import plotly.express as px
 import plotly.graph_objects as go
-import pandas as pd
+import plotly.colors
+import numpy as np
+
+import solar_api
+import solar_artifacts
+import solar_cache
+import solar_cube
+import solar_forecast
+import solar_geometry
+import solar_hexbin
+import solar_metrics
+import solar_regions
+import solar_timeline
+
+# -------------- Settings -------------------------------------------
+
+# Year slider handled in the browser: the yearly values of the selected layer are sent once,
+# then the map and the share plot are recolored by clientside callbacks (assets/clientside.js)
+clientside_year = os.environ.get("SOLAR_CLIENTSIDE_YEAR", "0") == "1"
+
+# The year only triggers server callbacks when it is not handled in the browser
+year_dependency = State if clientside_year else Input
+
+# Decimals kept in the coordinates of the map geometry (6 ~ 0.1 m, "none" for full precision)
+coordinate_decimals = os.environ.get("SOLAR_COORDINATE_DECIMALS", "6")
+coordinate_decimals = None if coordinate_decimals == "none" else int(coordinate_decimals)
+
+# Targets of the canton [MWc] shown on the expansion plot, unless other targets of the exponential model are entered
+canton_targets = {2030: 350, 2050: 1000}
+
+# Encodings of the responses negotiated with the browser (Accept-Encoding), in order of preference (empty: none)
+compress_algorithms = [name for name in os.environ.get("SOLAR_COMPRESS", "br,gzip").split(",") if name]
 
 # -------------- Data import -------------------------------------------
 
-# Load GIS data
-girec_lin = pd.read_pickle("output/girec_lin.pickle")
-girec_exp = pd.read_pickle("output/girec_exp.pickle")
-communes_lin = pd.read_pickle("output/communes_lin.pickle")
-communes_exp = pd.read_pickle("output/communes_exp.pickle")
+# Figures cached on disk for previous versions of the artifacts or other settings are not needed anymore
+solar_cache.configure(coordinate_decimals=coordinate_decimals)
+solar_cache.clear_stale()
+
+# Values of every registered forecast model computed by the pipeline, as views of the memory-mapped artifacts
+# (the cube derived from them is built by each worker, the geometry, the same for all the models, is only read
+# from the first one)
+models = [name for name in solar_forecast.models if solar_artifacts.exists(f"girec_{name}")]
+
+layers = {model: solar_artifacts.arrays(f"girec_{model}", solar_cube.years + ["pv_potential"]) for model in models}
+units = layers[models[0]][0]
+
+# Communes and custom region sets, aggregated from the girecs with their membership matrix (solar_regions)
+regions = solar_regions.load(units)
+
+# Installation density on hexagonal grids of several cell sizes, drawn according to the zoom (solar_hexbin)
+grids = solar_hexbin.load(
+    units, [year for year in solar_cube.years if year <= solar_forecast.current_year]
+)
+
+# Read-only values of every map and plot, callbacks only look them up
+cube = solar_cube.build_cube(layers, regions, grids)
+
+# Commissioning dates of the installations of the girecs and of the cells of the grids, the capacity at the end of
+# the historical months being looked up on the fly (solar_timeline)
+timelines = {}
+installations = solar_artifacts.read("installations") if solar_artifacts.exists("installations") else None
+if installations is not None and "date" in installations:
+    timelines["girec"] = solar_timeline.build(
+        cube["index"]["girec"], installations["girec"], installations["date"], installations["power"]
+    )
+    for name, grid in grids.items():
+        cells = solar_hexbin.cell_ids(*solar_hexbin.cells(installations["x"].to_numpy(), installations["y"].to_numpy(), grid["size"]))
+        timelines[name] = solar_timeline.build(grid["index"], cells, installations["date"], installations["power"])
+
+month_labels = ["janv.", "févr.", "mars", "avr.", "mai", "juin", "juil.", "août", "sept.", "oct.", "nov.", "déc."]
+
+# Prediction intervals of the canton capacity (P10/P50/P90 per year) of the models simulating paths
+bands = {
+    model: solar_artifacts.read(f"bands_{model}").query("granularity == 'canton'").set_index("year")
+    for model in models if solar_artifacts.exists(f"bands_{model}")
+}
+
+# Geometry of each granularity (the same for all the models)
+geometries = {"girec": solar_artifacts.read(f"girec_{models[0]}", columns=["geometry"]).geometry}
+geometries.update({name: solar_artifacts.read(solar_regions.artifact(name), columns=["geometry"]).geometry for name in regions})
+geometries.update({name: grid["geometry"] for name, grid in grids.items()})
+
+# Simplified geometry levels of each granularity, keyed by tolerance in meters, quantized to the coordinate decimals
+levels = {
+    granularity: {
+        tolerance: solar_geometry.quantize(geometry, coordinate_decimals)
+        for tolerance, geometry in solar_geometry.load_levels(
+            solar_regions.artifact(granularity) if granularity in regions else granularity, geometries[granularity]
+        ).items()
+    }
+    for granularity in geometries
+}
+
+# Labels of the granularities, region sets other than the communes being named after their file
+granularity_labels = {"communes": "Communes", "girec": "Sous-secteurs statistiques (GIREC)"}
+granularity_labels.update({name: name for name in regions if name not in granularity_labels})
+if grids:
+    granularity_labels["hexbin"] = "Densité des installations"
+
+
+def zoom_only(granularity):
+    # Callback fired by a change of the zoom level while the granularity does not depend on it (never when the
+    # function is called outside of a request, e.g. by solar_render)
+    return has_request_context() and ctx.triggered_id == 'map-level' and granularity != "hexbin"
+
+
+def month_values(granularity, year, month):
+    # Capacity of the units at the end of a month of a historical year, None for the yearly values of the cube
+    if month in (None, 12) or year > solar_forecast.current_year or "girec" not in timelines:
+        return None
+
+    date = solar_timeline.month_end(year, month)
+    if granularity in timelines:
+        return solar_timeline.capacity_at(timelines[granularity], date).round(4)
+
+    return solar_timeline.capacity_at(timelines["girec"], date, regions[granularity][0]).round(4)
+
+
+def drawn_granularity(granularity, level):
+    # Grid of the installation density whose cells suit the zoom level, the granularity itself otherwise
+    if granularity == "hexbin":
+        return solar_hexbin.granularity(solar_hexbin.size_for_level(level))
+
+    return granularity
 
-borders = communes_lin[['geometry']]
+# Outline of all the communes as a single line trace, computed once per geometry level
+borders = {tolerance: solar_geometry.outline(geometry) for tolerance, geometry in levels["communes"].items()}
+
+# Initial zoom of the map
+map_zoom = 10.9
+
+# GeoJSON of each granularity and level, serialized once at startup (geometry is the same for all the models)
+geojson = {
+    granularity: {tolerance: geometry.__geo_interface__ for tolerance, geometry in granularity_levels.items()}
+    for granularity, granularity_levels in levels.items()
+}
 
 # -------------- Styling -------------------------------------------
 
@@ -23,6 +153,21 @@ app = Dash(
 )
 server = app.server
 
+# Compressed responses (layout, callbacks, assets and data API), the metrics recording the size before compression
+if compress_algorithms:
+    server.config["COMPRESS_ALGORITHM"] = compress_algorithms
+    server.config["COMPRESS_MIMETYPES"] = [
+        "text/html", "text/css", "text/plain", "text/javascript", "application/javascript", "application/json",
+        "text/csv", "application/geo+json",
+    ]
+    Compress(server)
+
+# Latency and payload of the callbacks published on /metrics (Prometheus)
+solar_metrics.instrument(server)
+
+# Read-only JSON/CSV data API of the values and geometry of the app (/api/v1)
+solar_api.register(server, cube, levels, bands)
+
 app.layout = dbc.Container([
     # Colors line
     dbc.Row(
@@ -155,8 +300,7 @@ app.layout = dbc.Container([
                 dcc.RadioItems(
                     id='granularity-input',
                     options=[
-                        {'label': ' Communes', 'value': "communes"},
-                        {'label': ' Sous-secteurs statistiques (GIREC)', 'value': "girec"},
+                        {'label': f' {label}', 'value': granularity} for granularity, label in granularity_labels.items()
                     ],
                     value="communes",
                     inline=True,
@@ -283,6 +427,7 @@ app.layout = dbc.Container([
     Input('tabs', 'active_tab'),
     Input('metric-input', 'value'),
 )
+@solar_metrics.timed("render_content")
 def render_content(tab, metric):
     if tab == 'tab-past':
         min_year = 2005
@@ -312,8 +457,31 @@ def render_content(tab, metric):
             style={'display': 'block' if metric != 'potential' else 'none'},
         ),
 
+        # Month of the historical years (capacity at the end of the month), the year slider of the browser
+        # (SOLAR_CLIENTSIDE_YEAR) only knowing the yearly values
+        html.Div(
+            [
+                dcc.Markdown("##### Sélection du mois"),
+                dcc.Slider(
+                    id='month-input',
+                    min=1,
+                    max=12,
+                    step=1,
+                    value=12,
+                    marks={month: label for month, label in enumerate(month_labels, start=1)},
+                )],
+            className='slider-container',
+            style={'display': 'block' if tab == 'tab-past' and metric != 'potential' and timelines and not clientside_year else 'none'},
+        ),
+
         # Main map at the top
         dcc.Graph(id='map'),
+        # Granularity, borders and geometry level currently drawn on the map
+        dcc.Store(id='map-base'),
+        # Geometry level matching the zoom of the map
+        dcc.Store(id='map-level', data=solar_geometry.level_for_zoom(solar_geometry.tolerances, map_zoom)),
+        # Yearly values of the selected layer, used by the clientside year slider
+        dcc.Store(id='year-matrix'),
 
         # Model selection
         html.Div([
@@ -333,11 +501,25 @@ def render_content(tab, metric):
             dcc.Markdown("##### Modèle de croissance"),
             dcc.RadioItems(
                 id='model-input',
-                options=[
-                    {'label': ' Linéaire', 'value': "linear"},
-                    {'label': ' Exponentiel (objectif 1 MWc)', 'value': "exponential"},
-                ],
-                value="linear")],
+                options=[{'label': f" {solar_forecast.models[model]['label']}", 'value': model} for model in models],
+                value=models[0]),
+            # Targets of the exponential model, its scenarios being computed on the fly
+            dcc.Markdown("##### Objectifs du modèle exponentiel [MWc]"),
+            dcc.Input(
+                id='target-2030-input',
+                type='number',
+                min=0,
+                placeholder='2030',
+                value=None,
+                style={'margin-left': '0x', 'margin-right': '10px'}
+            ),
+            dcc.Input(
+                id='target-2050-input',
+                type='number',
+                min=0,
+                placeholder='2050',
+                value=solar_forecast.exponential_targets[2050]
+            )],
             style={'display': 'block' if tab == 'tab-future' else 'none'}
         ),
 
@@ -362,10 +544,117 @@ def render_content(tab, metric):
     ])
 
 
+@solar_cache.cached
+def base_map_figure(granularity, show_borders, tolerance):
+    # Map figure without colors, built once per granularity, borders setting and geometry level
+    fig = go.Figure(
+        go.Choroplethmapbox(
+            geojson=geojson[granularity][tolerance],
+            locations=cube["index"][granularity],
+            coloraxis="coloraxis",
+            marker={"opacity": 0.7},
+        )
+    )
+
+    fig.update_layout(
+        mapbox={"style": "open-street-map", "center": {"lat": 46.2250, "lon": 6.1432}, "zoom": map_zoom},
+        margin={"r": 0, "t": 0, "l": 0, "b": 0},
+        height=800,
+        width=1200,
+        uirevision="map",  # Keep the user's view when the geometry level is swapped
+    )
+
+    if show_borders:
+        lon, lat = borders.get(tolerance, borders[0])
+
+        fig.add_trace(
+            go.Scattermapbox(
+                lon=lon,
+                lat=lat,
+                mode='lines',
+                line=dict(color='black', width=2),
+                hoverinfo='skip',
+                showlegend=False,
+            )
+        )
+
+    return fig.to_plotly_json()
+
+
+def scenario_targets(model, target_2030, target_2050):
+    # Canton targets of the exponential model as a hashable key of the cached figures (None for the other models).
+    # A blank 2050 target is the default one, the growth rate of the 2030 target not being extrapolated to 2050
+    target_2050 = target_2050 or solar_forecast.exponential_targets[2050]
+    targets = tuple((year, float(target)) for year, target in [(2030, target_2030), (2050, target_2050)] if target)
+
+    if model != "exp" or not targets:
+        return None
+
+    return targets
+
+
+def ratio_colorscale(year):
+    if year < 2025:
+        return plotly.colors.get_colorscale("blues")
+
+    objective_2030 = 0.35
+    objective_2050 = 0.95
+    y_objective = objective_2030 + ((year - 2030) * (objective_2050 - objective_2030)) / (2050 - 2030)
+    smoothing = 0.02 / y_objective
+
+    return [
+        (0.0, "darkred"),
+        (y_objective - smoothing, "lightcoral"),
+        (y_objective + smoothing, "lightgreen"),
+        (1.0, "darkgreen"),
+    ]
+
+
+@solar_cache.cached
+def map_colors(year, granularity, metric, model, potential_scaling, min_scale, max_scale, targets=None, month=None):
+    # Color array of the choropleth trace and the matching color axis
+    values = solar_cube.lookup(cube, granularity, model, potential_scaling, metric, year, targets)
+
+    power = month_values(granularity, year, month) if metric != "potential" else None
+    if power is not None:
+        potential = solar_cube.lookup(cube, granularity, model, potential_scaling, "potential", year)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            values = power if metric == "power" else 100 * power / potential
+
+    if metric == "potential":
+        units = "MWc"
+        color_scale = "oranges"
+    elif metric == "power":
+        units = "MWc"
+        color_scale = "oranges"
+    else:
+        units = "%"
+
+        color_scale = ratio_colorscale(year)
+
+    if isinstance(color_scale, str):
+        # Named scales are resolved here, plotly.js only knows a few of them
+        color_scale = plotly.colors.get_colorscale(color_scale)
+
+    trace = {
+        "z": values,
+        "hovertemplate": f"{cube['index'][granularity].name}=%{{location}}<br>{units}=%{{z}}<extra></extra>",
+    }
+    coloraxis = {
+        "colorscale": color_scale,
+        "cmin": min_scale,
+        "cmax": max_scale,
+        "colorbar": {"title": {"text": units}},
+    }
+
+    return trace, coloraxis
+
+
 # Callback to update the map based on selected year and granularity
 @app.callback(
     Output('map', 'figure'),
-    Input('year-input', 'value'),
+    Output('map-base', 'data'),
+    year_dependency('year-input', 'value'),
     Input('granularity-input', 'value'),
     Input('borders-input', 'value'),
     Input('metric-input', 'value'),
@@ -373,108 +662,86 @@ def render_content(tab, metric):
     Input('potential-input', 'value'),
     Input('min-value-input', 'value'),
     Input('max-value-input', 'value'),
+    Input('target-2030-input', 'value'),
+    Input('target-2050-input', 'value'),
+    Input('map-level', 'data'),
+    State('map-base', 'data'),
+    Input('month-input', 'value'),
 )
-def update_map(year, granularity, show_borders, metric, model, potential_scaling, min_scale, max_scale):
-    if granularity == "communes" and model == "linear":
-        data = communes_lin
-    elif granularity == "communes" and model == "exponential":
-        data = communes_exp
-    elif granularity == "girec" and model == "linear":
-        data = girec_lin
-    else:
-        data = girec_exp
+@solar_metrics.timed("update_map")
+def update_map(year, granularity, show_borders, metric, model, potential_scaling, min_scale, max_scale,
+               target_2030=None, target_2050=None, level=0, drawn_base=None, month=None):
+    granularity = drawn_granularity(granularity, level)
 
-    data["potential"] = data["pv_potential"] / potential_scaling
+    # Finest available level that is not finer than the one requested by the zoom
+    tolerance = max(tolerance for tolerance in levels[granularity] if tolerance <= level)
 
-    if metric == "potential":
-        data_to_plot = "potential"
-        units = "MWc"
-        color_scale = "oranges"
-    elif metric == "power":
-        data_to_plot = year
-        units = "MWc"
-        color_scale = "oranges"
-    else:
-        data["ratio"] = 100 * data[year] / data["potential"]
-        data_to_plot = "ratio"
-        units = "%"
+    base = [granularity, show_borders, tolerance]
 
-        if year < 2025:
-            color_scale = "blues"
-        else:
-            objective_2030 = 0.35
-            objective_2050 = 0.95
-            y_objective = objective_2030 + ((year - 2030) * (objective_2050 - objective_2030)) / (2050 - 2030)
-            smoothing = 0.02 / y_objective
-            color_scale = [
-                (0.0, "darkred"),
-                (y_objective - smoothing, "lightcoral"),
-                (y_objective + smoothing, "lightgreen"),
-                (1.0, "darkgreen"),
-            ]
-
-    try:
-        range_for_plot = [min_scale, max_scale]
-    except TypeError:
-        range_for_plot = None
-
-    fig = px.choropleth_mapbox(
-        data_frame=data,
-        geojson=data.geometry.__geo_interface__,
-        locations=data.index,
-        color=data_to_plot,
-        range_color=range_for_plot,
-        color_continuous_scale=color_scale,
-        opacity=0.7,
-        mapbox_style="open-street-map",
-        center={"lat": 46.2250, "lon": 6.1432},
-        zoom=10.9,
-        labels={str(data_to_plot): units}
-    )
+    targets = scenario_targets(model, target_2030, target_2050)
+    trace, coloraxis = map_colors(year, granularity, metric, model, potential_scaling, min_scale, max_scale, targets, month)
 
-    fig.update_layout(margin={"r": 0, "t": 0, "l": 0, "b": 0}, height=800, width=1200)
+    if drawn_base == base:
+        # The geometry is already on the client, only send the new colors
+        fig = Patch()
+        fig["data"][0].update(trace)
+        fig["layout"]["coloraxis"] = coloraxis
+        return fig, no_update
 
-    if show_borders:
-        for geom in borders.geometry:
-            if geom.geom_type == 'Polygon':
-                x, y = geom.exterior.xy
-            elif geom.geom_type == 'MultiPolygon':
-                # Commune Céligny has multiple polygons
-                for polygon in geom.geoms:
-                    x, y = polygon.exterior.xy
-
-            fig.add_trace(
-                go.Scattermapbox(
-                    lon=list(x),
-                    lat=list(y),
-                    mode='lines',
-                    line=dict(color='black', width=2),
-                    hoverinfo='skip',
-                    showlegend=False,
-                )
-            )
+    fig = base_map_figure(granularity, show_borders, tolerance)
+    fig = {
+        "data": [{**fig["data"][0], **trace}] + fig["data"][1:],
+        "layout": {**fig["layout"], "coloraxis": coloraxis},
+    }
+
+    return fig, base
+
+
+# Callback to swap the geometry level when the zoom crosses a level threshold
+@app.callback(
+    Output('map-level', 'data'),
+    Input('map', 'relayoutData'),
+    State('map-level', 'data'),
+    prevent_initial_call=True,
+)
+@solar_metrics.timed("update_map_level")
+def update_map_level(relayout, level):
+    if not relayout or "mapbox.zoom" not in relayout:
+        return no_update
 
-    return fig
+    new_level = solar_geometry.level_for_zoom(solar_geometry.tolerances, relayout["mapbox.zoom"])
+
+    return new_level if new_level != level else no_update
 
 
 @app.callback(
     Output('plot-expansion', 'figure'),
     Output('plot-share', 'figure'),
-    Input('year-input', 'value'),
+    year_dependency('year-input', 'value'),
     Input('granularity-input', 'value'),
     Input('model-input', 'value'),
+    Input('target-2030-input', 'value'),
+    Input('target-2050-input', 'value'),
+    Input('map-level', 'data'),
+    Input('month-input', 'value'),
 )
-def update_plots(year, granularity, model):
-    if granularity == "communes" and model == "linear":
-        data = communes_lin
-    elif granularity == "communes" and model == "exponential":
-        data = communes_exp
-    elif granularity == "girec" and model == "linear":
-        data = girec_lin
-    else:
-        data = girec_exp
+@solar_metrics.timed("update_plots")
+def update_plots(year, granularity, model, target_2030=None, target_2050=None, level=0, month=None):
+    # The zoom only changes the share plot of the installation density, whose cells follow it
+    if zoom_only(granularity):
+        return no_update, no_update
 
-    total_capacity_by_year = data.sum(numeric_only=True)
+    granularity = drawn_granularity(granularity, level)
+
+    # The targets scale all the units alike, the share does not depend on them
+    targets = scenario_targets(model, target_2030, target_2050)
+
+    return expansion_figure(granularity, model, targets), share_figure(year, granularity, model, month)
+
+
+@solar_cache.cached
+def expansion_figure(granularity, model, targets=None):
+    total_capacity_by_year = solar_cube.totals(cube, granularity, model, targets)
 
     fig_expansion = px.line(
         x=total_capacity_by_year.index,
@@ -485,32 +752,126 @@ def update_plots(year, granularity, model):
     )
     fig_expansion.update_traces(line=dict(color="orange"), mode="lines+markers")
 
+    y_max = total_capacity_by_year.max()
+    if model in bands and targets is None:
+        # Band between P10 and P90 of the simulated paths, starting from the current capacity
+        band = bands[model]
+        current = total_capacity_by_year[[solar_forecast.current_year]]
+
+        fig_expansion.add_trace(
+            go.Scatter(
+                x=list(current.index) + list(band.index) + list(band.index[::-1]) + list(current.index),
+                y=list(current) + list(band["p90"]) + list(band["p10"][::-1]) + list(current),
+                fill="toself",
+                fillcolor="rgba(255, 165, 0, 0.2)",
+                line=dict(width=0),
+                hoverinfo="skip",
+                name="P10 - P90",
+            )
+        )
+        fig_expansion.add_trace(
+            go.Scatter(
+                x=band.index,
+                y=band["p50"],
+                mode="lines",
+                line=dict(color="orange", dash="dot"),
+                name="P50",
+            )
+        )
+        y_max = max(y_max, band["p90"].max())
+
+    # Targets of the scenario, those of the canton for the other models
+    shown_targets = dict(targets) if targets is not None else canton_targets
     fig_expansion.add_trace(
         go.Scatter(
-            x=[2030, 2050],
-            y=[350, 1000],
+            x=list(shown_targets),
+            y=list(shown_targets.values()),
             mode="markers+text",
             marker=dict(color="green", size=10, symbol="circle"),
-            text=["<b>Objectif 2030<br>350 MWc</b>", "<b>Objectif 2050<br>1000 MWc</b>"],
+            text=[f"<b>Objectif {year}<br>{target:g} MWc</b>" for year, target in shown_targets.items()],
             textposition="middle left"
         )
     )
     fig_expansion.update_layout(
         xaxis=dict(range=[2005, 2055]),  # Ensure x-axis includes entire range
-        yaxis=dict(range=[0, 1100]),  # Adjust y-axis range for better display
+        yaxis=dict(range=[0, 1.1 * max(1000, y_max, *shown_targets.values())]),  # Adjust y-axis range for better display
         showlegend=False
     )
 
+    return fig_expansion.to_plotly_json()
+
+
+@solar_cache.cached
+def share_figure(year, granularity, model, month=None):
+    power = month_values(granularity, year, month)
+    if power is None:
+        date = year
+        power = solar_cube.lookup(cube, granularity, model, solar_cube.potential_scalings[0], "power", year)
+    else:
+        date = f"{month_labels[month - 1]} {year}"
+
     fig_share = px.bar(
-        x=data.index,
-        y=data[year].values / data[year].sum() * 100,
+        x=cube["index"][granularity],
+        y=power / np.nansum(power) * 100,
         labels={'x': 'Commune', 'y': '[%]'},
-        title=f"Répartition de la capacité photovoltaïque déployée en {year}",
+        title=f"Répartition de la capacité photovoltaïque déployée en {date}",
         template="plotly_white"
     )
     fig_share.update_traces(marker_color='orange')
 
-    return fig_expansion, fig_share
+    return fig_share.to_plotly_json()
+
+
+if clientside_year:
+    # Yearly values sent once per granularity, model and potential, year changes stay in the browser
+    @app.callback(
+        Output('year-matrix', 'data'),
+        Input('granularity-input', 'value'),
+        Input('model-input', 'value'),
+        Input('potential-input', 'value'),
+        Input('target-2030-input', 'value'),
+        Input('target-2050-input', 'value'),
+        Input('map-level', 'data'),
+    )
+    @solar_metrics.timed("update_year_matrix")
+    def update_year_matrix(granularity, model, potential_scaling, target_2030=None, target_2050=None, level=0):
+        if zoom_only(granularity):
+            return no_update
+
+        granularity = drawn_granularity(granularity, level)
+        targets = scenario_targets(model, target_2030, target_2050)
+
+        return {
+            "years": solar_cube.years,
+            "power": solar_cube.year_matrix(cube, granularity, model, potential_scaling, "power", targets),
+            "potential": solar_cube.lookup(cube, granularity, model, potential_scaling, "potential", solar_cube.years[0]),
+            "ratio_colorscales": [ratio_colorscale(year) for year in solar_cube.years],
+        }
+
+    app.clientside_callback(
+        ClientsideFunction(namespace='solar', function_name='recolor_map'),
+        Output('map', 'figure', allow_duplicate=True),
+        Input('year-input', 'value'),
+        State('year-matrix', 'data'),
+        State('metric-input', 'value'),
+        State('map', 'figure'),
+        prevent_initial_call=True,
+    )
+
+    app.clientside_callback(
+        ClientsideFunction(namespace='solar', function_name='update_share'),
+        Output('plot-share', 'figure', allow_duplicate=True),
+        Input('year-input', 'value'),
+        State('year-matrix', 'data'),
+        State('plot-share', 'figure'),
+        prevent_initial_call=True,
+    )
+
+
+# Counters of the figure cache of the worker serving the request, size of the shared disk tier
+@server.route("/cache-stats")
+def cache_stats():
+    return solar_cache.info()
 
 
 if __name__ == '__main__':
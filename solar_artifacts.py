@@ -0,0 +1,165 @@
+import glob
+import os
+import tempfile
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# Output artifacts of the pipeline as uncompressed Arrow IPC files (geometry stored as WKB). They are opened
+# memory-mapped: the numeric columns read are zero-copy views of the file, backed by the page cache that the
+# app workers share, and only the requested columns are materialized. Text, index and geometry columns are
+# still decoded (copied) by each worker.
+
+output_dir = "output"
+
+# Version of the layout of the artifacts, checked when they are opened (1: Parquet, 2: Arrow IPC)
+schema_version = 2
+
+_version_key = b"solar:schema_version"
+
+
+def path(name):
+    return os.path.join(output_dir, f"{name}.arrow")
+
+
+def exists(name):
+    return os.path.exists(path(name))
+
+
+def _write_table(name, table):
+    # Missing floats are stored as NaN rather than nulls, so that the columns can be read without copy.
+    # Written to a temporary file then renamed, the app never opens a partial artifact
+    columns = [
+        pc.fill_null(column, np.nan) if pa.types.is_floating(column.type) and column.null_count else column
+        for column in table.columns
+    ]
+    schema = table.schema.with_metadata({**(table.schema.metadata or {}), _version_key: str(schema_version).encode()})
+
+    # A single record batch, each column being one contiguous array of the file
+    table = pa.Table.from_arrays(columns, schema=schema).combine_chunks()
+
+    with tempfile.NamedTemporaryFile(dir=output_dir, suffix=".arrow", delete=False) as f:
+        with pa.ipc.new_file(f, schema, options=pa.ipc.IpcWriteOptions(compression=None)) as writer:
+            writer.write_table(table)
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, path(name))
+
+
+def _read_table(name, columns=None):
+    # Table of the memory-mapped file (no data is read until the columns are accessed), limited to some
+    # columns and the index
+    table = pa.ipc.open_file(pa.memory_map(path(name))).read_all()
+    version = (table.schema.metadata or {}).get(_version_key)
+
+    if version != str(schema_version).encode():
+        raise ValueError(
+            f"{path(name)} has schema version {version and version.decode()}, expected {schema_version}: "
+            "rerun solar_process or migrate the previous outputs with solar_artifacts"
+        )
+
+    if columns is None:
+        return table
+
+    index_columns = [column for column in (table.schema.pandas_metadata or {}).get("index_columns", []) if isinstance(column, str)]
+
+    return table.select([column for column in columns if column not in index_columns] + index_columns)
+
+
+def write(name, frame):
+    # GeoDataFrame of a layer (year columns are stored as strings) or DataFrame without geometry
+    frame = frame.rename(columns=str)
+
+    if isinstance(frame, gpd.GeoDataFrame):
+        _write_table(name, pa.table(frame.to_arrow(index=True, geometry_encoding="WKB")))
+    else:
+        _write_table(name, pa.Table.from_pandas(frame))
+
+
+def read(name, columns=None):
+    # Layer written by write, limited to some columns (the index is always read). A GeoDataFrame if the
+    # geometry is read (all its columns copied by geopandas), a DataFrame otherwise, its numeric columns being
+    # read-only views of the file.
+    table = _read_table(name, None if columns is None else [str(column) for column in columns])
+
+    if "geometry" in table.column_names:
+        frame = gpd.GeoDataFrame.from_arrow(table)
+    else:
+        # One block per column, pandas not copying them into a consolidated array
+        frame = table.to_pandas(split_blocks=True)
+
+    return frame.rename(columns=lambda column: int(column) if column.isdigit() else column)
+
+
+def write_levels(name, levels):
+    # Simplified geometry levels {tolerance: GeoSeries}, one geometry column per tolerance
+    frame = gpd.GeoDataFrame({str(tolerance): geometry for tolerance, geometry in levels.items()}, geometry=str(min(levels)))
+    _write_table(f"{name}_levels", pa.table(frame.to_arrow(index=True, geometry_encoding="WKB")))
+
+
+def arrays(name, columns):
+    # Zero-copy read-only views of numeric columns of a layer {column: array}, and its index
+    table = _read_table(name, [str(column) for column in columns])
+    index = read(name, columns=[]).index
+
+    return index, {column: table.column(str(column)).chunk(0).to_numpy(zero_copy_only=True) for column in columns}
+
+
+def read_levels(name):
+    frame = gpd.GeoDataFrame.from_arrow(_read_table(f"{name}_levels"))
+
+    return {int(tolerance): frame[tolerance] for tolerance in frame.columns}
+
+
+def migrate(remove=False):
+    # Convert the outputs of previous versions of the pipeline (pickles, Parquet artifacts) into artifacts. The
+    # commune layers per model are not read anymore, the communes being a region set of the girecs built here
+    # if the outputs have none (solar_regions). The artifacts of the region sets are renamed with their prefix.
+    previous_paths = sorted(glob.glob(os.path.join(output_dir, "*.pickle")) + glob.glob(os.path.join(output_dir, "*.parquet")))
+    has_regions = exists("regions") or any(os.path.splitext(os.path.basename(p))[0] == "regions" for p in previous_paths)
+
+    for previous_path in previous_paths:
+        name, extension = os.path.splitext(os.path.basename(previous_path))
+
+        # Levels of the commune layers of the outputs without region sets, rebuilt with the communes region set
+        if name.startswith("communes_") and (name != "communes_levels" or not has_regions):
+            print(f"{previous_path} skipped")
+            continue
+
+        if extension == ".pickle":
+            value = pd.read_pickle(previous_path)
+
+            if name.endswith("_levels"):
+                write_levels(name[:-len("_levels")], value)
+            else:
+                write(name, value)
+        else:
+            _write_table(name, pq.read_table(previous_path))
+
+        if remove:
+            os.remove(previous_path)
+
+        print(f"{previous_path} -> {path(name)}")
+
+    # Imported here, solar_regions reading and writing its sets with this module
+    import solar_regions
+
+    if exists("regions"):
+        for name in read("regions")["region_set"].unique():
+            for previous, renamed in [(name, solar_regions.artifact(name)), (f"{name}_levels", f"{solar_regions.artifact(name)}_levels")]:
+                if exists(previous) and not exists(renamed):
+                    os.replace(path(previous), path(renamed))
+                    print(f"{path(previous)} -> {path(renamed)}")
+
+    layers = sorted(glob.glob(os.path.join(output_dir, "girec_*.arrow")))
+    layers = [os.path.splitext(os.path.basename(layer))[0] for layer in layers if not layer.endswith("_levels.arrow")]
+    if not exists("regions") and layers:
+        solar_regions.write_communes(layers[0])
+        print(f"communes region set built from {path(layers[0])}")
+
+
+if __name__ == '__main__':
+    migrate()
@@ -0,0 +1,266 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import plotly
+import shapely
+
+import solar_artifacts
+import solar_forecast
+import solar_geometry
+import solar_hexbin
+import solar_process
+import solar_regions
+import solar_timeline
+
+# Benchmarks of the pipeline stages on synthetic fixtures of configurable size and of the Dash callbacks on
+# the output artifacts. Results are written to a JSON file that a later run (e.g. on another commit) can
+# be compared to, the run failing if a timing regressed by more than the threshold.
+#
+#   python solar_benchmark.py --output before.json
+#   python solar_benchmark.py --baseline before.json --threshold 0.2
+
+
+def fixtures(girecs=475, installations=20000, years=20, seed=0):
+    # Square girecs on a grid around Geneva (EPSG:2056), ten per commune, and installations spread over them
+    rng = np.random.default_rng(seed)
+    side = int(np.ceil(np.sqrt(girecs)))
+    size = 500  # [m]
+
+    x, y = np.divmod(np.arange(girecs), side)
+    polygons = shapely.box(2490000 + x * size, 1110000 + y * size, 2490000 + (x + 1) * size, 1110000 + (y + 1) * size)
+
+    girec = gpd.GeoDataFrame(
+        {"NOM": [f"girec {i}" for i in range(girecs)], "NO_COMM": np.arange(girecs) // 10},
+        geometry=polygons,
+        crs="EPSG:2056",
+    )
+    communes = pd.DataFrame({"NO_COMM": np.arange(girecs // 10 + 1), "COMMUNE": [f"commune {i}" for i in range(girecs // 10 + 1)]})
+
+    first_year = solar_forecast.current_year - years + 1
+    located = rng.integers(0, girecs, installations)
+    pronovo = gpd.GeoDataFrame(
+        {
+            "TotalPower": rng.gamma(2, 10, installations),
+            "BeginningOfOperation": pd.to_datetime(f"{first_year}-01-01") + pd.to_timedelta(rng.integers(0, 365 * years, installations), "D"),
+        },
+        # Within the girecs (the last row of the grid is not full)
+        geometry=shapely.points(
+            2490000 + (x[located] + rng.random(installations)) * size, 1110000 + (y[located] + rng.random(installations)) * size
+        ),
+        crs="EPSG:2056",
+    )
+    potential = pd.DataFrame({"pv_potential": rng.gamma(2, 5, girecs)}, index=girec["NOM"])
+
+    return {"girec": girec, "communes": communes, "pronovo": pronovo, "potential": potential, "years": list(range(first_year, solar_forecast.current_year + 1))}
+
+
+def measure(function, repeat):
+    # Best time of the repeats [s] (the least disturbed by other processes) and the last result
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+
+    return min(times), result
+
+
+def benchmark_pipeline(data, repeat):
+    # Stage functions of the pipeline (solar_process) on the fixtures, in a temporary directory for the files
+    # they read and write (registry, installation assignment, artifacts)
+    girec, communes, years = data["girec"], data["communes"], data["years"]
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        registry = os.path.join(directory, "pronovo.gpkg")
+        data["pronovo"].to_file(registry, driver="GPKG")
+
+        results["read_pronovo"], pronovo = measure(
+            lambda: solar_process.read_pronovo(registry, girec, solar_process.pronovo_chunk_size), repeat
+        )
+        results["assignment"], _ = measure(
+            lambda: solar_geometry.assign_points(pronovo.geometry.values, girec.geometry.values), repeat
+        )
+
+        assignment_path, solar_process.assignment_path = solar_process.assignment_path, os.path.join(directory, "assignment.pickle")
+        try:
+            # Every installation resolved (first run), then all of them taken from the previous run
+            def merge():
+                if os.path.exists(solar_process.assignment_path):
+                    os.remove(solar_process.assignment_path)
+                return solar_process.merge_photovoltaic(pronovo, girec, communes)
+
+            results["merge_photovoltaic"], photovoltaic = measure(merge, repeat)
+            results["merge_photovoltaic_reused"], _ = measure(
+                lambda: solar_process.merge_photovoltaic(pronovo, girec, communes), repeat
+            )
+        finally:
+            solar_process.assignment_path = assignment_path
+
+        results["historical_values"], girec_historical = measure(
+            lambda: solar_process.historical_values(photovoltaic, girec, communes, years), repeat
+        )
+
+        geometry = solar_process.unit_geometry(girec, communes)
+        results["build_levels"], _ = measure(lambda: solar_process.levels(geometry), repeat)
+
+        installations = solar_process.installation_points(photovoltaic)
+        size = min(solar_hexbin.sizes.values())  # Finest grid
+        results["hexbin"], _ = measure(lambda: solar_process.hexbin(installations, geometry, size, years), repeat)
+
+        historical = girec_historical[years].to_numpy(dtype=float)
+        horizon = 2050 - solar_forecast.current_year
+
+        results["holt"], forecast = measure(lambda: solar_forecast.forecast_holt(solar_forecast.fit_holt(historical), horizon), repeat)
+        results["bands"], _ = measure(
+            lambda: solar_forecast.forecast_bands("lin", historical, np.full(len(historical), np.nan), horizon,
+                                                  {"canton": solar_regions.canton(girec_historical.index)}, paths=500),
+            repeat,
+        )
+        results["exponential"], _ = measure(
+            lambda: solar_forecast.exponential_scenario(historical[:, -1], solar_forecast.exponential_targets, horizon), repeat
+        )
+
+        girec_model = solar_process.girec_model(
+            girec_historical,
+            (pd.DataFrame(forecast, index=girec_historical.index, columns=range(solar_forecast.current_year + 1, 2051)),),
+            data["potential"],
+        )
+
+        membership = solar_regions.matrix(
+            solar_regions.assignment_membership(girec_model["COMMUNE"]), girec_model.index, pd.Index(communes["COMMUNE"])
+        )
+        results["aggregate"], _ = measure(lambda: solar_regions.aggregate(membership, girec_model[years].to_numpy().T), repeat)
+
+        timeline = solar_timeline.build(
+            girec_model.index, installations["girec"], installations["date"].to_numpy(), installations["power"]
+        )
+        results["timeline_monthly"], _ = measure(
+            lambda: solar_timeline.monthly(timeline, f"{years[0]}-01-01", f"{years[-1]}-12-31", membership), repeat
+        )
+        results["output_frame"], output = measure(lambda: solar_process.output_frame(girec_model), repeat)
+
+        output_dir, solar_artifacts.output_dir = solar_artifacts.output_dir, directory
+        try:
+            results["artifact_write"], _ = measure(lambda: solar_artifacts.write("girec_benchmark", output), repeat)
+            results["artifact_read"], _ = measure(lambda: solar_artifacts.read("girec_benchmark"), repeat)
+        finally:
+            solar_artifacts.output_dir = output_dir
+
+    return {name: {"seconds": seconds} for name, seconds in results.items()}
+
+
+def benchmark_callbacks(repeat):
+    # End to end timings of the callbacks on the output artifacts, without cache (cold) and from the figure cache
+    # (cached), with the size of the serialized figures sent to the browser
+    os.environ["SOLAR_CACHE_DIR"] = tempfile.mkdtemp()
+
+    import solar_app
+    import solar_cache
+
+    def cold(function):
+        def run():
+            with solar_cache._lock:
+                solar_cache._memory.clear()
+            shutil.rmtree(solar_cache.cache_dir, ignore_errors=True)
+            return function()
+        return run
+
+    def size(figure):
+        return len(json.dumps(figure, cls=plotly.utils.PlotlyJSONEncoder))
+
+    level = solar_geometry.level_for_zoom(solar_geometry.tolerances, solar_app.map_zoom)
+    model = solar_app.models[0]
+    results = {}
+
+    for granularity in ["communes", "girec"]:
+        def update_map(year=2030, drawn_base=None):
+            return solar_app.update_map(year, granularity, True, "ratio", model, 3, None, None, None, None, level, drawn_base)
+
+        def update_plots(year=2030):
+            return solar_app.update_plots(year, granularity, model)
+
+        seconds, (figure, base) = measure(cold(update_map), repeat)
+        results[f"update_map_{granularity}"] = {"seconds": seconds, "bytes": size(figure)}
+
+        seconds, (patch, _) = measure(lambda: update_map(2031, base), repeat)
+        results[f"update_map_{granularity}_patch"] = {"seconds": seconds, "bytes": size(patch)}
+
+        seconds, figures = measure(cold(update_plots), repeat)
+        results[f"update_plots_{granularity}"] = {"seconds": seconds, "bytes": sum(size(figure) for figure in figures)}
+
+        seconds, figures = measure(update_plots, repeat)
+        results[f"update_plots_{granularity}_cached"] = {"seconds": seconds, "bytes": sum(size(figure) for figure in figures)}
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    # Relative change of the timings against the baseline, regressions being slower by more than the threshold
+    comparison = pd.DataFrame({
+        "baseline [s]": {name: value["seconds"] for name, value in baseline["results"].items()},
+        "current [s]": {name: value["seconds"] for name, value in results["results"].items()},
+    }).dropna()
+    comparison["change"] = comparison["current [s]"] / comparison["baseline [s]"] - 1
+    comparison["regression"] = comparison["change"] > threshold
+
+    return comparison
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of the solar pipeline stages and Dash callbacks")
+    parser.add_argument("--girecs", type=int, default=475, help="Number of girec polygons of the fixture")
+    parser.add_argument("--installations", type=int, default=20000, help="Number of installations of the fixture")
+    parser.add_argument("--years", type=int, default=20, help="Number of historical years of the fixture")
+    parser.add_argument("--repeat", type=int, default=3, help="Repeats of each measure, the best one is kept")
+    parser.add_argument("--skip-callbacks", action="store_true", help="Only benchmark the pipeline stages")
+    parser.add_argument("--output", default="benchmark.json", help="File the results are written to")
+    parser.add_argument("--baseline", help="Results of a previous run to compare to")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Relative slowdown counted as a regression")
+    args = parser.parse_args(argv)
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+
+    parameters = {"girecs": args.girecs, "installations": args.installations, "years": args.years, "repeat": args.repeat}
+    data = fixtures(args.girecs, args.installations, args.years)
+
+    results = {"commit": commit, "parameters": parameters, "results": benchmark_pipeline(data, args.repeat)}
+    if not args.skip_callbacks:
+        results["results"].update(benchmark_callbacks(args.repeat))
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print(pd.DataFrame(results["results"]).T)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        if baseline["parameters"] != parameters:
+            print(f"Warning: the baseline was measured with {baseline['parameters']}")
+
+        comparison = compare(results, baseline, args.threshold)
+        print(comparison)
+
+        if comparison["regression"].any():
+            print(f"Regressions (slower by more than {args.threshold:.0%}): {', '.join(comparison.index[comparison['regression']])}")
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,191 @@
+import functools
+import glob
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+import plotly.io
+
+# Two-tier cache of the figures built by the Dash callbacks: an in-process LRU in front of an on-disk
+# cache shared by all the gunicorn workers. Entries are keyed on the function, its arguments and the
+# version of the output artifacts and code, so that a deploy or a pipeline run never serves stale figures.
+# Figures are stored on disk as JSON (never unpickled from a directory every worker writes to), the disk tier
+# being bounded in bytes: the least recently used entries are pruned once it grows past the bound, whatever
+# the number of distinct free-form inputs (color scale bounds, scenario targets) sent by the visitors.
+
+cache_dir = os.environ.get("SOLAR_CACHE_DIR", "cache")
+max_entries = int(os.environ.get("SOLAR_CACHE_SIZE", "256"))  # Bound of the in-process LRU
+max_disk_bytes = int(os.environ.get("SOLAR_CACHE_DISK_BYTES", str(512 * 2 ** 20)))  # Bound of the disk tier
+
+stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "disk_evictions": 0}
+
+_memory = OrderedDict()
+_lock = threading.Lock()
+_disk_bytes = None  # Size of the disk tier seen by this worker, rescanned when pruning
+
+
+def artifacts_version(settings=None):
+    # Hash of the output artifacts, of the code building figures from them and of the settings changing them
+    digest = hashlib.sha256(repr(sorted((settings or {}).items())).encode())
+
+    for path in sorted(glob.glob("output/*") + glob.glob("*.py") + glob.glob("assets/*")):
+        digest.update(path.encode())
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+
+    return digest.hexdigest()[:16]
+
+
+version = artifacts_version()
+
+
+def configure(**settings):
+    # Settings of the app the figures depend on (e.g. the coordinate decimals), entries built with other
+    # settings not being served
+    global version
+    version = artifacts_version(settings)
+
+
+def _disk_path(key):
+    return os.path.join(cache_dir, version, key[:2], f"{key}.json")
+
+
+def _disk_entries():
+    # Entries of the disk tier (path, size, last use), all the workers sharing them
+    entries = []
+    for path in glob.glob(os.path.join(cache_dir, version, "*", "*.json")):
+        try:
+            status = os.stat(path)
+        except OSError:
+            continue  # Pruned by another worker
+        entries.append((path, status.st_size, status.st_mtime))
+
+    return entries
+
+
+def _prune_disk():
+    # Remove the least recently used entries until the disk tier is back under 80% of its bound
+    global _disk_bytes
+
+    entries = sorted(_disk_entries(), key=lambda entry: entry[2])
+    total = sum(size for _, size, _ in entries)
+
+    for path, size, _ in entries:
+        if total <= 0.8 * max_disk_bytes:
+            break
+        try:
+            os.remove(path)
+            stats["disk_evictions"] += 1
+        except OSError:
+            pass
+        total -= size
+
+    _disk_bytes = total
+
+
+def _read_disk(key):
+    path = _disk_path(key)
+
+    try:
+        with open(path) as f:
+            value = json.load(f)
+        os.utime(path)  # Last use, for the pruning
+        return value
+    except (OSError, ValueError):
+        return None
+
+
+def _write_disk(key, value):
+    # Written to a temporary file then renamed, so that other workers never read a partial entry
+    global _disk_bytes
+    path = _disk_path(key)
+
+    try:
+        data = plotly.io.json.to_json_plotly(value).encode()
+        if len(data) > max_disk_bytes:
+            return
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as f:
+            f.write(data)
+        os.replace(f.name, path)
+
+        with _lock:
+            if _disk_bytes is None:
+                _disk_bytes = sum(size for _, size, _ in _disk_entries())
+            else:
+                _disk_bytes += len(data)
+
+            if _disk_bytes > max_disk_bytes:
+                _prune_disk()
+    except OSError:
+        pass  # The disk tier is only an optimization
+
+
+def _remember(key, value):
+    with _lock:
+        _memory[key] = value
+        _memory.move_to_end(key)
+
+        while len(_memory) > max_entries:
+            _memory.popitem(last=False)
+            stats["evictions"] += 1
+
+
+def cached(function):
+    # Cache the (immutable) result of a function of hashable arguments in both tiers.
+    # Results are shared between requests and must not be modified by the callers. Read back from the disk
+    # tier, they are decoded from JSON (lists instead of arrays and tuples).
+    @functools.wraps(function)
+    def wrapper(*args):
+        key = hashlib.sha256(repr((function.__qualname__, args)).encode()).hexdigest()
+
+        with _lock:
+            if key in _memory:
+                _memory.move_to_end(key)
+                stats["memory_hits"] += 1
+                return _memory[key]
+
+        value = _read_disk(key)
+        hit = value is not None
+
+        if not hit:
+            value = function(*args)
+            _write_disk(key, value)
+
+        with _lock:
+            stats["disk_hits" if hit else "misses"] += 1
+
+        _remember(key, value)
+
+        return value
+
+    return wrapper
+
+
+def info():
+    # Counters and in-process entries of the worker serving the request (each gunicorn worker has its own),
+    # size of the disk tier shared by all the workers
+    disk = _disk_entries()
+
+    return {
+        "worker": os.getpid(),
+        **stats,
+        "entries": len(_memory),
+        "max_entries": max_entries,
+        "disk_entries": len(disk),
+        "disk_bytes": sum(size for _, size, _ in disk),
+        "max_disk_bytes": max_disk_bytes,
+        "version": version,
+    }
+
+
+def clear_stale():
+    # Remove the disk entries of previous artifact versions
+    for path in glob.glob(os.path.join(cache_dir, "*")):
+        if os.path.basename(path) != version:
+            shutil.rmtree(path, ignore_errors=True)
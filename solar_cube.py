@@ -0,0 +1,125 @@
+import numpy as np
+import pandas as pd
+
+import solar_forecast
+import solar_regions
+
+# Axes of the cube, the position of each value being its index along the axis
+years = list(range(2005, 2050 + 1))
+potential_scalings = [3, 1]
+metrics = ["potential", "power", "ratio"]
+
+
+def build_cube(layers, regions, grids=None):
+    # Read-only arrays of every value the app can show, indexed by (model, potential scaling, metric, year, unit)
+    # for each granularity. Callbacks only look values up and never write into shared data.
+    # layers: {model: (index, {column: array})} of the girecs as written by solar_process, in order of the models,
+    # the year and pv_potential columns being the views of the artifacts (solar_artifacts.arrays)
+    # regions: {granularity: (membership matrix, index of the regions)} aggregated from the girecs (solar_regions)
+    # grids: {granularity: grid} of the installation density (solar_hexbin), exact for the historical years
+    models = list(layers)
+    index = layers[models[0]][0]
+
+    power = np.full((len(models), len(years), len(index)), np.nan)
+    potential = np.full((len(models), len(index)), np.nan)
+
+    for i, model in enumerate(models):
+        model_index, columns = layers[model]
+        position = index.get_indexer(model_index)
+        keep = position >= 0
+
+        for j, year in enumerate(years):
+            power[i, j, position[keep]] = columns[year][keep]
+        potential[i, position[keep]] = columns["pv_potential"][keep]
+
+    cube = {"models": models, "index": {"girec": index}, "values": {}}
+
+    # Installed capacity of the canton per year, the same whatever the granularity
+    cube["totals"] = solar_regions.aggregate(solar_regions.canton(index), np.nan_to_num(power))[..., 0]
+    cube["totals"].flags.writeable = False
+
+    grids = grids or {}
+
+    for granularity, (_, regions_index) in regions.items():
+        cube["index"][granularity] = regions_index
+    for granularity, grid in grids.items():
+        cube["index"][granularity] = grid["index"]
+
+    for granularity in cube["index"]:
+        if granularity == "girec":
+            granularity_power, granularity_potential = power, potential
+        elif granularity in grids:
+            grid = grids[granularity]
+            granularity_power = solar_regions.aggregate(grid["capacity"], power)
+            granularity_power[:, :len(grid["historical"])] = grid["historical"]
+            granularity_potential = solar_regions.aggregate(grid["area"], potential)
+        else:
+            membership = regions[granularity][0]
+            granularity_power = solar_regions.aggregate(membership, power)
+            granularity_potential = solar_regions.aggregate(membership, potential)
+
+        values = np.empty((len(models), len(potential_scalings), len(metrics), len(years), len(cube["index"][granularity])))
+
+        for j, potential_scaling in enumerate(potential_scalings):
+            scaled = granularity_potential[:, None, :] / potential_scaling
+
+            values[:, j, metrics.index("potential")] = scaled
+            values[:, j, metrics.index("power")] = granularity_power
+            with np.errstate(divide="ignore", invalid="ignore"):
+                values[:, j, metrics.index("ratio")] = 100 * granularity_power / scaled
+
+        values.flags.writeable = False
+        cube["values"][granularity] = values
+
+    return cube
+
+
+def scenario(cube, granularity, targets):
+    # Values of the exponential model for other canton targets {year: capacity [MWc]}, computed on the fly from
+    # the historical values (the same for all the models), indexed by (potential scaling, metric, year, unit)
+    values = cube["values"][granularity][0].copy()
+    current = solar_forecast.current_year - years[0]
+
+    # Growth rates from the canton total, regions not covering the whole canton get the same ones
+    power = solar_forecast.exponential_scenario(
+        values[0, metrics.index("power"), current], targets, years[-1] - solar_forecast.current_year,
+        total=cube["totals"][0, current],
+    ).T
+
+    values[:, metrics.index("power"), current + 1:] = power
+    with np.errstate(divide="ignore", invalid="ignore"):
+        values[:, metrics.index("ratio"), current + 1:] = 100 * power / values[:, metrics.index("potential"), current + 1:]
+
+    values.flags.writeable = False
+
+    return values
+
+
+def layer(cube, granularity, model, targets=None):
+    # Values of a model indexed by (potential scaling, metric, year, unit), those of a scenario if targets are given
+    if targets is not None:
+        return scenario(cube, granularity, targets)
+
+    return cube["values"][granularity][cube["models"].index(model)]
+
+
+def lookup(cube, granularity, model, potential_scaling, metric, year, targets=None):
+    # Values of all the units of a granularity (read-only view)
+    values = layer(cube, granularity, model, targets)
+
+    return values[potential_scalings.index(potential_scaling), metrics.index(metric), year - years[0]]
+
+
+def year_matrix(cube, granularity, model, potential_scaling, metric, targets=None):
+    # Values of all the units for all the years, one row per year (read-only view)
+    values = layer(cube, granularity, model, targets)
+
+    return values[potential_scalings.index(potential_scaling), metrics.index(metric)]
+
+
+def totals(cube, granularity, model, targets=None):
+    # Total installed capacity of the canton per year (from the girecs, the regions may not cover the canton)
+    if targets is not None:
+        return pd.Series(np.nansum(year_matrix(cube, "girec", model, potential_scalings[0], "power", targets), axis=1), index=years)
+
+    return pd.Series(cube["totals"][cube["models"].index(model)], index=years)
@@ -0,0 +1,407 @@
+import itertools
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+# %% Holt's linear trend model, fitted on all the series at once
+
+def holt_filter(y, alpha, beta, level, trend, phi=1):
+    # One-step-ahead predictions of Holt's (damped) linear trend method for a batch of series
+    # y: (..., years), alpha, beta, phi, level and trend broadcast against y[..., 0]
+    shape = np.broadcast_shapes(y.shape[:-1], np.shape(alpha), np.shape(phi), np.shape(level))
+    predictions = np.empty(shape + y.shape[-1:])
+
+    for t in range(y.shape[-1]):
+        predictions[..., t] = level + phi * trend
+        new_level = alpha * y[..., t] + (1 - alpha) * (level + phi * trend)
+        trend = beta * (new_level - level) + (1 - beta) * phi * trend
+        level = new_level
+
+    return predictions, level, trend
+
+
+def holt_initial_states(y, alpha, beta, phi=1):
+    # For given smoothing parameters the predictions are linear in the initial level and trend,
+    # which are therefore solved exactly by least squares. Returns the initial states and the SSE.
+    zero = np.zeros(np.broadcast_shapes(np.shape(alpha), np.shape(phi)))
+    data_part, _, _ = holt_filter(y, alpha, beta, zero, zero, phi)
+    # Responses to a unit initial level and trend, independent of the series
+    level_part, _, _ = holt_filter(np.zeros(y.shape[-1:]), alpha, beta, zero + 1, zero, phi)
+    trend_part, _, _ = holt_filter(np.zeros(y.shape[-1:]), alpha, beta, zero, zero + 1, phi)
+
+    residuals = y - data_part
+
+    a11 = np.sum(level_part * level_part, axis=-1)
+    a12 = np.sum(level_part * trend_part, axis=-1)
+    a22 = np.sum(trend_part * trend_part, axis=-1)
+    c1 = np.sum(level_part * residuals, axis=-1)
+    c2 = np.sum(trend_part * residuals, axis=-1)
+
+    det = a11 * a22 - a12 * a12
+    singular = det <= 1e-12 * a11 * a22
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        level0 = np.where(singular, c1 / a11, (a22 * c1 - a12 * c2) / det)
+        trend0 = np.where(singular, 0, (a11 * c2 - a12 * c1) / det)
+
+    sse = np.sum((residuals - level0[..., None] * level_part - trend0[..., None] * trend_part) ** 2, axis=-1)
+
+    return level0, trend0, sse
+
+
+def _holt_parameters(params):
+    # Searched parameters (alpha, beta / alpha[, phi]) to (alpha, beta, phi)
+    alpha = params[..., 0]
+    phi = params[..., 2] if params.shape[-1] > 2 else 1
+
+    return alpha, alpha * params[..., 1], phi
+
+
+def fit_holt(y, damped=False, grid_size=21, starts=4, tolerance=1e-6, max_rows=2 ** 18):
+    # Least squares fit of Holt's linear trend model (alpha, beta <= alpha, damping phi if damped, initial level
+    # and trend) on every row of y (series x years), as statsmodels' ExponentialSmoothing(trend='add') does per
+    # series. The smoothing parameters are searched on a coarse grid, then refined by a compass search per series
+    # started from its best few grid points, as the SSE surface can have several local minima.
+    y = np.asarray(y, dtype=float)
+    fit = {name: np.empty(len(y)) for name in ["alpha", "beta", "phi", "level0", "trend0", "sse", "level", "trend"]}
+
+    # Coarse grid in (alpha, beta / alpha), so that the beta <= alpha constraint is a square, and phi
+    # within the bounds used by statsmodels
+    axes = [np.linspace(0, 1, grid_size)] * 2 + ([np.linspace(0.8, 0.995, 5)] if damped else [])
+    grid = np.stack([axis.ravel() for axis in np.meshgrid(*axes, indexing="ij")], axis=-1)
+    lower = np.array([axis[0] for axis in axes])
+    upper = np.array([axis[-1] for axis in axes])
+    spacing = (upper - lower) / np.array([len(axis) - 1 for axis in axes])
+
+    # Compass directions, the current point first
+    directions = np.array(list(itertools.product((0, 1, -1), repeat=len(axes))))
+
+    # Series per chunk, bounding the size of the (series x grid x years) arrays
+    chunk_size = max(1, max_rows // len(grid))
+
+    for start in range(0, len(y), chunk_size):
+        chunk = y[start:start + chunk_size, None, :]  # (series, 1, years)
+
+        _, _, sse = holt_initial_states(chunk, *_holt_parameters(grid))
+        params = grid[np.argsort(sse, axis=1)[:, :starts].ravel()]
+
+        # One row per series and start
+        chunk = np.repeat(chunk, starts, axis=0)
+
+        # Move to the best neighbour of each row, doubling its step when it improves and halving it otherwise,
+        # until the step of every row is below the tolerance
+        step = np.ones(len(chunk))
+        active = np.arange(len(chunk))
+        while len(active):
+            candidates = params[active, None] + step[active, None, None] * directions * spacing
+            candidates = np.clip(candidates, lower, upper)
+
+            _, _, sse = holt_initial_states(chunk[active], *_holt_parameters(candidates))
+            best = np.argmin(sse, axis=1)
+
+            # Moves within rounding noise would wander along flat valleys without ever converging
+            best[sse[np.arange(len(active)), best] >= sse[:, 0] * (1 - 1e-10)] = 0
+
+            params[active] = candidates[np.arange(len(active)), best]
+            step[active] = np.where(best == 0, step[active] / 2, np.minimum(2 * step[active], 1))
+
+            active = active[step[active] * spacing.min() > tolerance]
+
+        # Best start of each series
+        _, _, sse = holt_initial_states(chunk[:, 0, :], *_holt_parameters(params))
+        best = np.argmin(sse.reshape(-1, starts), axis=1) + starts * np.arange(len(chunk) // starts)
+        chunk, params = chunk[best, 0, :], params[best]
+
+        alpha, beta, phi = _holt_parameters(params)
+        level0, trend0, sse = holt_initial_states(chunk, alpha, beta, phi)
+        _, level, trend = holt_filter(chunk, alpha, beta, level0, trend0, phi)
+
+        for name, value in zip(fit, [alpha, beta, phi, level0, trend0, sse, level, trend]):
+            fit[name][start:start + chunk_size] = value
+
+    return fit
+
+
+def forecast_holt(fit, horizon):
+    # Forecasts for the next horizon years (series x horizon), the trend being damped by phi each year
+    damping = np.cumsum(fit["phi"][:, None] ** np.arange(1, horizon + 1), axis=1)
+
+    return fit["level"][:, None] + damping * fit["trend"][:, None]
+
+
+def simulate_holt(y, fit, indices):
+    # Future paths (series x paths x horizon) of the fitted model, each step adding a one-step-ahead residual of
+    # the series to the prediction and updating the level and trend with it. indices (paths x horizon): historical
+    # year of the residual drawn at each step, shared by all the series so that neighbouring units stay correlated
+    # and their summed paths do not underestimate the spread of the regions.
+    alpha, beta, phi = (fit[name][:, None] for name in ["alpha", "beta", "phi"])
+    predictions, _, _ = holt_filter(y, fit["alpha"], fit["beta"], fit["level0"], fit["trend0"], fit["phi"])
+
+    # Residuals centered on each series, the median path following the point forecast
+    residuals = y[:, 1:] - predictions[:, 1:]
+    residuals = np.concatenate([np.zeros((len(y), 1)), residuals - residuals.mean(axis=1, keepdims=True)], axis=1)
+    residuals = residuals[:, indices]  # (series, paths, horizon)
+
+    level = np.repeat(fit["level"][:, None], len(indices), axis=1)
+    trend = np.repeat(fit["trend"][:, None], len(indices), axis=1)
+    paths = np.empty(residuals.shape)
+
+    for h in range(indices.shape[1]):
+        prediction = level + phi * trend
+        paths[..., h] = prediction + residuals[..., h]
+        new_level = prediction + alpha * residuals[..., h]
+        trend = beta * (new_level - level) + (1 - beta) * phi * trend
+        level = new_level
+
+    return paths
+
+
+def compare_with_statsmodels(y, horizon, damped=False, tolerance=1e-2):
+    # Fits every series with statsmodels as well and compares the forecasts (absolute difference, in the
+    # units of y) and the SSE. The batch fit is a global search, its SSE should never be noticeably larger.
+    import warnings
+    from statsmodels.tools.sm_exceptions import ConvergenceWarning
+    from statsmodels.tsa.holtwinters import ExponentialSmoothing
+
+    y = np.asarray(y, dtype=float)
+    fit = fit_holt(y, damped=damped)
+    forecast = forecast_holt(fit, horizon)
+
+    comparison = []
+    for i, series in enumerate(y):
+        # statsmodels warns about every series whose optimizer does not converge, only during its fits
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", ConvergenceWarning)
+            statsmodels_fit = ExponentialSmoothing(series, trend='add', damped_trend=damped, seasonal=None).fit()
+
+        comparison.append({
+            "max_abs_diff": np.max(np.abs(statsmodels_fit.forecast(horizon) - forecast[i])),
+            "sse": fit["sse"][i],
+            "sse_statsmodels": statsmodels_fit.sse,
+        })
+
+    comparison = pd.DataFrame(comparison)
+    comparison["within_tolerance"] = comparison["max_abs_diff"] <= tolerance
+
+    return comparison
+
+
+# %% Registry of the forecast models
+# Each model forecasts a chunk of spatial units from their historical values (units x years, the last column
+# being the current year) and potential. The pipeline writes an output/girec_<name> artifact per model,
+# the communes being aggregated from it. A model may define prepare(historical, potential), computing parameters over all
+# the units (e.g. from canton totals) that are then passed to every chunk. Models reading the potential
+# declare it, the pipeline only recomputing their forecasts when the potential changes.
+
+models = {}
+
+# Last year of the historical data, the first forecast being the next year
+current_year = 2024
+
+# Canton capacity targets [MWc] of the exponential model written by the pipeline, the app computing
+# the scenarios of other targets on the fly
+exponential_targets = {2050: 1000}
+
+
+# Prediction intervals of the models that can simulate paths (bootstrapped residuals), as percentiles of
+# the simulated capacities of every unit and year
+band_percentiles = [10, 50, 90]
+band_paths = 2000
+
+
+def register(name, label, prepare=None, potential=False, simulate=None):
+    # simulate(historical, potential, indices): paths (units x paths x horizon), see simulate_holt
+    def decorator(function):
+        models[name] = {"label": label, "forecast": function, "prepare": prepare, "potential": potential, "simulate": simulate}
+        return function
+
+    return decorator
+
+
+def simulate_linear(historical, potential, indices):
+    return simulate_holt(historical, fit_holt(historical), indices)
+
+
+@register("lin", "Linéaire", simulate=simulate_linear)
+def forecast_linear(historical, potential, horizon):
+    return forecast_holt(fit_holt(historical), horizon)
+
+
+# A coarser start than the linear model is enough with the additional phi axis
+damped_search = {"damped": True, "grid_size": 11, "starts": 2}
+
+
+def simulate_damped(historical, potential, indices):
+    return simulate_holt(historical, fit_holt(historical, **damped_search), indices)
+
+
+@register("damped", "Linéaire amorti", simulate=simulate_damped)
+def forecast_damped(historical, potential, horizon):
+    return forecast_holt(fit_holt(historical, **damped_search), horizon)
+
+
+def exponential_scenario(current, targets, horizon, total=None):
+    # Closed form exponential growth of every unit through the canton targets {year: capacity [MWc]}, all units
+    # and years at once. The log of the canton total is linear between the targets (constant growth rate
+    # r = ln(target / y_0) / (target_year - previous_year) on each segment) and keeps the last rate afterwards.
+    # total: canton capacity of the current year, the sum of current by default (needed for chunks of units)
+    current = np.asarray(current, dtype=float)
+    total = np.nansum(current) if total is None else total
+    targets = {year: value for year, value in dict(targets).items() if year > current_year}
+
+    knots = np.array([current_year] + sorted(targets), dtype=float)
+    log_growth = np.log(np.array([total] + [targets[year] for year in sorted(targets)], dtype=float) / total)
+    forecast_years = current_year + np.arange(1, horizon + 1)
+
+    growth = np.interp(forecast_years, knots, log_growth)
+    if len(knots) > 1:
+        rate = (log_growth[-1] - log_growth[-2]) / (knots[-1] - knots[-2])
+        growth = np.where(forecast_years > knots[-1], log_growth[-1] + rate * (forecast_years - knots[-1]), growth)
+
+    return current[..., None] * np.exp(growth)
+
+
+def prepare_exponential(historical, potential, targets=None):
+    # Current total of the canton, from which the growth rates are computed
+    return {"total": np.nansum(historical[:, -1]), "targets": exponential_targets if targets is None else targets}
+
+
+@register("exp", "Exponentiel (objectifs du canton)", prepare=prepare_exponential)
+def forecast_exponential(historical, potential, horizon, total, targets):
+    # Every unit grows from its current capacity at the rates required for the canton
+    return exponential_scenario(historical[:, -1], targets, horizon, total=total)
+
+
+@register("logistic", "Logistique (saturation au potentiel)", potential=True)
+def forecast_logistic(historical, potential, horizon):
+    # Logistic growth saturating at the potential of each unit: logit(y / potential) is linear in time,
+    # its slope is fitted on the years with installations and the curve goes through the current capacity
+    t = np.arange(historical.shape[1], dtype=float)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        share = historical / potential[:, None]
+        valid = (share > 0) & (share < 1)
+        logit = np.where(valid, np.log(share / (1 - share)), 0)
+
+        # Least squares slope over the valid years of each unit
+        count = valid.sum(axis=1)
+        t_mean = (t * valid).sum(axis=1) / count
+        logit_mean = logit.sum(axis=1) / count
+        covariance = ((t - t_mean[:, None]) * (logit - logit_mean[:, None]) * valid).sum(axis=1)
+        variance = ((t - t_mean[:, None]) ** 2 * valid).sum(axis=1)
+        rate = np.clip(np.nan_to_num(covariance / variance), 0, None)
+
+        current = np.clip(share[:, -1], 1e-9, 1 - 1e-9)
+        logit_forecast = np.log(current / (1 - current))[:, None] + rate[:, None] * np.arange(1, horizon + 1)
+        forecast = potential[:, None] / (1 + np.exp(-logit_forecast))
+
+    # Units without enough history or without potential left keep their current capacity
+    keep = (count < 2) | ~(potential > historical[:, -1])
+    forecast[keep] = historical[keep, -1:]
+
+    return forecast
+
+
+def _forecast_chunk(name, historical, potential, horizon, parameters):
+    start = time.perf_counter()
+    forecast = models[name]["forecast"](historical, potential, horizon, **parameters)
+
+    return forecast, time.perf_counter() - start
+
+
+def run_models(historical, potential, horizon, names=None, workers=None, chunk_size=100):
+    # Forecasts of the registered models (all of them by default) for every unit. The units are split in
+    # chunks fitted on a pool of worker processes (one per CPU by default, in process with workers=0).
+    # Returns the forecasts (units x horizon) of each model and their timings.
+    historical = np.asarray(historical, dtype=float)
+    potential = np.asarray(potential, dtype=float)
+    names = list(models) if names is None else names
+
+    # Workers are forked, spawning them would execute the pipeline script again in each of them
+    if workers == 0 or "fork" not in multiprocessing.get_all_start_methods():
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers or os.cpu_count(), mp_context=multiprocessing.get_context("fork"))
+
+    forecasts = {}
+    timings = []
+
+    for name in names:
+        start = time.perf_counter()
+
+        prepare = models[name]["prepare"]
+        parameters = prepare(historical, potential) if prepare else {}
+
+        chunks = [
+            (name, historical[i:i + chunk_size], potential[i:i + chunk_size], horizon, parameters)
+            for i in range(0, len(historical), chunk_size)
+        ]
+
+        if pool:
+            results = list(pool.map(_forecast_chunk, *zip(*chunks)))
+        else:
+            results = [_forecast_chunk(*chunk) for chunk in chunks]
+
+        forecasts[name] = np.concatenate([forecast for forecast, _ in results])
+        timings.append({
+            "model": name,
+            "chunks": len(chunks),
+            "wall [s]": time.perf_counter() - start,
+            "cpu [s]": sum(duration for _, duration in results),
+        })
+
+    if pool:
+        pool.shutdown()
+
+    return forecasts, pd.DataFrame(timings).set_index("model")
+
+
+def forecast_bands(name, historical, potential, horizon, aggregations=None, paths=band_paths, chunk_size=50, seed=0):
+    # Percentile bands of a model simulating paths, for every unit (units x percentiles x horizon) and for the
+    # regions of each aggregation {granularity: membership matrix (regions x units)}. The bands of the regions
+    # are percentiles of the summed paths of their units, not sums of percentiles. The units are simulated
+    # chunk by chunk, bounding the memory to chunk_size x paths x horizon values.
+    historical = np.asarray(historical, dtype=float)
+    potential = np.asarray(potential, dtype=float)
+    aggregations = aggregations or {}
+
+    # Residual years drawn for every path and step (the first year only reflects the fitted initial state)
+    indices = np.random.default_rng(seed).integers(1, historical.shape[1], (paths, horizon))
+
+    units = np.empty((len(historical), len(band_percentiles), horizon))
+    sums = {granularity: np.zeros((matrix.shape[0], paths * horizon)) for granularity, matrix in aggregations.items()}
+
+    for start in range(0, len(historical), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        simulated = models[name]["simulate"](historical[chunk], potential[chunk], indices)
+
+        units[chunk] = np.moveaxis(np.percentile(simulated, band_percentiles, axis=1), 0, 1)
+        for granularity, matrix in aggregations.items():
+            sums[granularity] += matrix[:, chunk] @ simulated.reshape(len(simulated), -1)
+
+    bands = {"units": units}
+    for granularity, values in sums.items():
+        values = values.reshape(len(values), paths, horizon)
+        bands[granularity] = np.moveaxis(np.percentile(values, band_percentiles, axis=1), 0, 1)
+
+    # Capacities cannot be negative, whatever the residuals drawn
+    return {granularity: np.maximum(value, 0) for granularity, value in bands.items()}
+
+
+if __name__ == '__main__':
+    # Check the batch fit against statsmodels on the historical values of the girec output
+    import solar_artifacts
+
+    historical = solar_artifacts.read("girec_lin", columns=range(2005, 2024 + 1)).to_numpy(dtype=float)
+
+    for damped in [False, True]:
+        comparison = compare_with_statsmodels(historical, len(range(2025, 2050 + 1)), damped=damped)
+
+        print("damped" if damped else "linear")
+        print(comparison.describe())
+        print("Series within tolerance : ", comparison["within_tolerance"].mean())
@@ -0,0 +1,202 @@
+import gzip
+import json
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+import solar_artifacts
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Simplification tolerances in meters (EPSG:2056), 0 being the full resolution geometry
+tolerances = [0, 2, 5, 10, 25]
+
+
+def simplify_shared(geometry, tolerance):
+    # Topology preserving simplification of a polygon coverage: borders shared by two units are
+    # simplified once as a single arc, so that they stay shared and no gaps or overlaps appear
+    if tolerance == 0:
+        return geometry
+
+    units = np.asarray(geometry.values)
+
+    # Node all the boundaries and merge them into arcs running between junctions
+    arcs = shapely.get_parts(shapely.line_merge(shapely.union_all(shapely.boundary(units))))
+
+    # Arc endpoints are kept by simplify, the junctions between units therefore do not move
+    arcs = shapely.simplify(arcs, tolerance, preserve_topology=True)
+
+    # Rebuild the faces of the coverage from the simplified arcs, noded again where they now touch
+    faces = shapely.get_parts(shapely.polygonize(shapely.get_parts(shapely.union_all(arcs))))
+
+    # Assign each face to the unit it overlaps the most
+    face_idx, unit_idx = shapely.STRtree(units).query(faces, predicate="intersects")
+    overlap = shapely.area(shapely.intersection(faces[face_idx], units[unit_idx]))
+    pairs = pd.DataFrame({"face": face_idx, "unit": unit_idx, "overlap": overlap})
+    pairs = pairs.sort_values("overlap").drop_duplicates("face", keep="last")
+
+    # Faces filling gaps of the coverage (lake, holes) do not belong to any unit
+    pairs = pairs[pairs["overlap"] >= 0.5 * shapely.area(faces[pairs["face"]])]
+
+    simplified = gpd.GeoSeries(faces[pairs["face"]], index=pairs["unit"].values, crs=geometry.crs)
+    simplified = simplified.groupby(level=0).agg(shapely.union_all)
+
+    # Units left without any face fall back to an independent simplification
+    result = shapely.simplify(units, tolerance, preserve_topology=True)
+    result[simplified.index] = simplified.values
+
+    return gpd.GeoSeries(result, index=geometry.index, crs=geometry.crs)
+
+
+def build_levels(geometry):
+    # Simplified versions of the geometry at each tolerance, returned in EPSG:4326
+    projected = geometry.to_crs("EPSG:2056")
+
+    return {tolerance: simplify_shared(projected, tolerance).to_crs("EPSG:4326") for tolerance in tolerances}
+
+
+def save_levels(name, geometry):
+    levels = build_levels(geometry)
+    write_levels(name, levels)
+
+    return levels
+
+
+def write_levels(name, levels):
+    # The full resolution level is already stored in the output GeoDataFrames
+    solar_artifacts.write_levels(name, {tolerance: value for tolerance, value in levels.items() if tolerance != 0})
+
+
+def load_levels(name, geometry):
+    # Full resolution only if the simplified levels were not computed by the pipeline
+    levels = {0: geometry}
+
+    if solar_artifacts.exists(f"{name}_levels"):
+        levels.update(solar_artifacts.read_levels(name))
+
+    return levels
+
+
+def quantize(geometry, decimals):
+    # Coordinates rounded to the decimals (EPSG:4326, 6 decimals ~ 0.1 m) and the vertices made identical by
+    # the rounding dropped, the GeoJSON sent to the browser carrying no more precision than the map can show
+    if decimals is None:
+        return geometry
+    if decimals < 0:
+        raise ValueError(f"Coordinate decimals must be positive or None, got {decimals}")
+
+    grid_size = 10.0 ** -decimals
+    try:
+        values = _round(np.asarray(geometry.values), grid_size)
+    except shapely.errors.GEOSException:
+        # Rings collapsing to less than 3 vertices at this precision (small units, few decimals): the geometries
+        # concerned are rounded to a valid output instead, their collapsed parts being dropped
+        values = np.array([_round_geometry(value, grid_size) for value in geometry.values], dtype=object)
+
+    # Units collapsing entirely keep their coordinates, not to disappear from the map
+    values = np.where(shapely.is_empty(values), np.asarray(geometry.values), values)
+
+    return gpd.GeoSeries(values, index=geometry.index, crs=geometry.crs)
+
+
+def _round(values, grid_size):
+    return shapely.remove_repeated_points(shapely.set_precision(values, grid_size, mode="pointwise"))
+
+
+def _round_geometry(geometry, grid_size):
+    try:
+        return _round(geometry, grid_size)
+    except shapely.errors.GEOSException:
+        return shapely.set_precision(geometry, grid_size, mode="valid_output")
+
+
+def level_for_zoom(levels, zoom):
+    # Coarsest level whose tolerance stays under half a screen pixel at this zoom
+    # (web mercator ground resolution at the latitude of Geneva)
+    pixel_size = 156543.03 * np.cos(np.radians(46.2)) / 2 ** zoom
+
+    return max([tolerance for tolerance in levels if tolerance <= pixel_size / 2], default=0)
+
+
+def outline(geometry):
+    # Coordinates of every ring (exterior and interior) of every polygon, separated by gaps (NaN),
+    # so that all the outlines can be drawn as a single line trace
+    rings = shapely.get_rings(shapely.get_parts(np.asarray(geometry.values)))
+    coordinates, ring_index = shapely.get_coordinates(rings, return_index=True)
+
+    gaps = np.flatnonzero(np.diff(ring_index)) + 1
+    coordinates = np.insert(coordinates, gaps, np.nan, axis=0)
+
+    return coordinates[:, 0], coordinates[:, 1]
+
+
+def assign_points(points, polygons):
+    # Position of the polygon covering each point (-1 if none) with a spatial index over the prepared polygons.
+    # Points on a border (shared by several polygons or not) are kept and flagged, those shared go to the first polygon.
+    polygons = np.asarray(polygons)
+    shapely.prepare(polygons)
+
+    point_idx, polygon_idx = shapely.STRtree(polygons).query(points)
+    covered = shapely.intersects(polygons[polygon_idx], points[point_idx])
+    order = np.lexsort((polygon_idx[covered], point_idx[covered]))
+    point_idx, polygon_idx = point_idx[covered][order], polygon_idx[covered][order]
+
+    inside = shapely.contains(polygons[polygon_idx], points[point_idx])
+
+    # First match of each point
+    first = np.unique(point_idx, return_index=True)[1]
+    assignment = np.full(len(points), -1)
+    assignment[point_idx[first]] = polygon_idx[first]
+
+    edge = np.zeros(len(points), dtype=bool)
+    edge[point_idx[~inside]] = True
+
+    return assignment, edge
+
+
+def levels_report(levels):
+    report = pd.DataFrame(
+        {
+            "vertices": [shapely.get_num_coordinates(value.values).sum() for value in levels.values()],
+            "bytes": [len(json.dumps(value.__geo_interface__)) for value in levels.values()],
+        },
+        index=pd.Index(list(levels.keys()), name="tolerance [m]"),
+    )
+    report["ratio"] = (report["bytes"] / report["bytes"].iloc[0]).round(3)
+
+    return report
+
+
+def payload_report(levels, decimals=6):
+    # Bytes of the GeoJSON of each level at full precision and quantized, then compressed as sent by the server
+    rows = []
+    for tolerance, geometry in levels.items():
+        raw = json.dumps(geometry.__geo_interface__).encode()
+        quantized = json.dumps(quantize(geometry, decimals).__geo_interface__).encode()
+
+        rows.append({
+            "raw": len(raw),
+            "quantized": len(quantized),
+            "gzip": len(gzip.compress(quantized, 6)),
+            "brotli": len(brotli.compress(quantized, quality=4)) if brotli is not None else np.nan,
+        })
+
+    report = pd.DataFrame(rows, index=pd.Index(list(levels.keys()), name="tolerance [m]"))
+    report["ratio"] = (report[["gzip", "brotli"]].min(axis=1) / report["raw"]).round(3)
+
+    return report
+
+
+if __name__ == '__main__':
+    # Compute the girec levels from existing outputs, without rerunning the whole pipeline
+    # (those of the region sets are dissolved from them by solar_regions)
+    geometry = solar_artifacts.read("girec_lin", columns=["geometry"]).geometry
+    levels = save_levels("girec", geometry)
+
+    print(levels_report(levels))
+    print(payload_report(levels))
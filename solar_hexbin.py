@@ -0,0 +1,117 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+import solar_artifacts
+import solar_regions
+
+# Density of the installations on hexagonal grids (pointy-top hexagons of a given circumradius in meters,
+# EPSG:2056, centered on the origin so that the cells are the same from one run to the other). The capacity
+# of the cells is exact for the historical years, the forecasts of the girecs being split between the cells
+# by the share of their current capacity installed in each of them.
+
+# Circumradius of the cells [m] of each grid, keyed by the simplification tolerance of the map from which it is
+# drawn (finer cells when zooming in)
+sizes = {0: 250, 10: 500, 25: 1000}
+
+
+def granularity(size):
+    return f"hexbin_{size}"
+
+
+def size_for_level(level):
+    return sizes[max(tolerance for tolerance in sizes if tolerance <= level)]
+
+
+def cells(x, y, size):
+    # Axial coordinates (q, r) of the cells containing the points, rounded in cube coordinates
+    q = (np.sqrt(3) / 3 * x - y / 3) / size
+    r = 2 / 3 * y / size
+    s = -q - r
+
+    rounded_q, rounded_r, rounded_s = np.round(q), np.round(r), np.round(s)
+    error_q, error_r, error_s = np.abs(rounded_q - q), np.abs(rounded_r - r), np.abs(rounded_s - s)
+
+    # The coordinate with the largest rounding error is derived from the two others
+    fix_q = (error_q > error_r) & (error_q > error_s)
+    fix_r = ~fix_q & (error_r > error_s)
+    rounded_q = np.where(fix_q, -rounded_r - rounded_s, rounded_q)
+    rounded_r = np.where(fix_r, -rounded_q - rounded_s, rounded_r)
+
+    return rounded_q.astype(int), rounded_r.astype(int)
+
+
+def cell_ids(q, r):
+    return np.char.add(np.char.add(q.astype(str), "_"), r.astype(str))
+
+
+def polygons(q, r, size):
+    # Hexagons of the cells, all at once
+    center_x = size * np.sqrt(3) * (q + r / 2)
+    center_y = size * 1.5 * r
+    angles = np.radians(30 + 60 * np.arange(6))
+
+    corners = np.stack([center_x[:, None] + size * np.cos(angles), center_y[:, None] + size * np.sin(angles)], axis=-1)
+
+    return shapely.polygons(corners)
+
+
+def hexbin(installations, girec, size, years):
+    # Cumulative capacity of the cells per historical year and membership of the girecs in the cells
+    # installations: DataFrame x, y (EPSG:2056), year, power [MWc] and girec; girec: GeoSeries (EPSG:2056) indexed by NOM
+    q, r = cells(installations["x"].to_numpy(), installations["y"].to_numpy(), size)
+    keys, cell = np.unique(np.stack([q, r], axis=1), axis=0, return_inverse=True)
+    cell = cell.ravel()
+    index = pd.Index(cell_ids(keys[:, 0], keys[:, 1]), name="cell")
+
+    # Capacity per cell and year (installations before the first year counted in it), cumulated over the years
+    year = np.clip(installations["year"].to_numpy() - years[0], 0, None)
+    keep = year < len(years)
+    power = installations["power"].to_numpy(dtype=float)
+    capacity = np.bincount(cell[keep] * len(years) + year[keep], weights=power[keep], minlength=len(index) * len(years))
+    capacity = np.cumsum(capacity.reshape(len(index), len(years)), axis=1)
+
+    geometry = gpd.GeoSeries(polygons(keys[:, 0], keys[:, 1], size), index=index, crs="EPSG:2056")
+    frame = gpd.GeoDataFrame(pd.DataFrame(capacity.round(4), index=index, columns=years), geometry=geometry)
+
+    # Share of the current capacity of each girec installed in each cell (forecasts) and share of its area
+    # (potential)
+    pairs = pd.DataFrame({"unit": installations["girec"].to_numpy()[keep], "region": index[cell[keep]], "power": power[keep]})
+    pairs = pairs.groupby(["unit", "region"], as_index=False)["power"].sum()
+    pairs["capacity"] = pairs["power"] / pairs.groupby("unit")["power"].transform("sum")
+
+    area = solar_regions.area_membership(girec, geometry).rename(columns={"weight": "area"})
+    membership = pairs[["unit", "region", "capacity"]].merge(area, on=["unit", "region"], how="outer").fillna(0)
+
+    return frame.to_crs("EPSG:4326"), membership
+
+
+def write(size, frame, membership):
+    solar_artifacts.write(granularity(size), frame)
+    solar_artifacts.write(f"{granularity(size)}_membership", membership)
+
+
+def load(units, years):
+    # Grids written by the pipeline {granularity: {"size", "index", "geometry", "historical" (years x cells),
+    # "capacity" and "area" membership matrices (cells x units)}}
+    grids = {}
+
+    for size in sizes.values():
+        name = granularity(size)
+        if not solar_artifacts.exists(name):
+            continue
+
+        frame = solar_artifacts.read(name)
+        membership = solar_artifacts.read(f"{name}_membership")
+
+        grids[name] = {
+            "size": size,
+            "index": frame.index,
+            "geometry": frame.geometry,
+            "historical": frame[years].to_numpy(dtype=float).T,
+            "capacity": solar_regions.matrix(membership.rename(columns={"capacity": "weight"}), units, frame.index),
+            "area": solar_regions.matrix(membership.rename(columns={"area": "weight"}), units, frame.index),
+        }
+
+    return grids
@@ -0,0 +1,149 @@
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import threading
+import time
+
+from flask import Response, g, has_request_context, request
+
+# Latency and payload instrumentation of the Dash callbacks, published on /metrics in the Prometheus text format.
+# The time spent in the callback functions (figure construction) is recorded apart from the whole request
+# (including the serialization of the response), the in-flight requests showing the contention of a worker.
+# Metrics are kept per process, each gunicorn worker exposing its own (worker label).
+
+# Requests slower than this [s] are logged with a profile of the request (disabled if not set)
+slow_callback = float(os.environ["SOLAR_SLOW_CALLBACK"]) if os.environ.get("SOLAR_SLOW_CALLBACK") else None
+
+seconds_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+bytes_buckets = (1e3, 1e4, 1e5, 3e5, 1e6, 3e6, 1e7)
+
+metrics = {
+    "solar_callback_seconds": ("histogram", "Time spent in the callback function", seconds_buckets),
+    "solar_request_seconds": ("histogram", "Time of the whole callback request, serialization included", seconds_buckets),
+    "solar_response_bytes": ("histogram", "Size of the serialized callback response", bytes_buckets),
+    "solar_callback_triggers_total": ("counter", "Inputs that fired the callback", None),
+    "solar_requests_in_flight": ("gauge", "Callback requests being processed by the worker", None),
+}
+
+logger = logging.getLogger("solar.metrics")
+
+_values = {}  # (metric, labels): value, or [bucket counts, sum, count] for histograms
+_lock = threading.Lock()
+_worker = str(os.getpid())
+
+
+def observe(metric, labels, value):
+    buckets = metrics[metric][2]
+    key = (metric, tuple(sorted({**labels, "worker": _worker}.items())))
+
+    with _lock:
+        histogram = _values.setdefault(key, [[0] * len(buckets), 0.0, 0])
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+
+def increment(metric, labels, value=1):
+    key = (metric, tuple(sorted({**labels, "worker": _worker}.items())))
+
+    with _lock:
+        _values[key] = _values.get(key, 0) + value
+
+
+def _format_labels(labels):
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+def render():
+    lines = []
+
+    with _lock:
+        for metric, (kind, description, buckets) in metrics.items():
+            lines += [f"# HELP {metric} {description}", f"# TYPE {metric} {kind}"]
+
+            for (name, labels), value in sorted(_values.items()):
+                if name != metric:
+                    continue
+
+                if kind == "histogram":
+                    counts, total, count = value
+                    for bound, bucket_count in zip(buckets, counts):
+                        lines.append(f"{metric}_bucket{_format_labels(labels + (('le', f'{bound:g}'),))} {bucket_count}")
+                    lines.append(f"{metric}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+                    lines.append(f"{metric}_sum{_format_labels(labels)} {total}")
+                    lines.append(f"{metric}_count{_format_labels(labels)} {count}")
+                else:
+                    lines.append(f"{metric}{_format_labels(labels)} {value}")
+
+    return "\n".join(lines) + "\n"
+
+
+def timed(name):
+    # Wrap a callback function: time of the function and name of the callback for the request metrics
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                observe("solar_callback_seconds", {"callback": name}, time.perf_counter() - start)
+                if has_request_context():
+                    g.solar_callback = name
+
+        return wrapper
+
+    return decorator
+
+
+def instrument(server, path="/metrics"):
+    # Request hooks of the Dash callbacks of the Flask server and the route publishing the metrics
+    def is_callback():
+        return request.path.endswith("_dash-update-component")
+
+    @server.before_request
+    def start_request():
+        if not is_callback():
+            return
+
+        g.solar_start = time.perf_counter()
+        increment("solar_requests_in_flight", {})
+
+        if slow_callback is not None:
+            g.solar_profile = cProfile.Profile()
+            g.solar_profile.enable()
+
+    @server.after_request
+    def end_request(response):
+        if not is_callback() or "solar_start" not in g:
+            return response
+
+        seconds = time.perf_counter() - g.solar_start
+        increment("solar_requests_in_flight", {}, -1)
+
+        callback = g.get("solar_callback", "other")
+        observe("solar_request_seconds", {"callback": callback}, seconds)
+        observe("solar_response_bytes", {"callback": callback}, response.calculate_content_length() or 0)
+
+        body = request.get_json(silent=True) or {}
+        for changed in body.get("changedPropIds", []):
+            increment("solar_callback_triggers_total", {"callback": callback, "input": changed})
+
+        if slow_callback is not None:
+            g.solar_profile.disable()
+
+            if seconds > slow_callback:
+                dump = io.StringIO()
+                pstats.Stats(g.solar_profile, stream=dump).sort_stats("cumulative").print_stats(25)
+                logger.warning("Slow callback %s (%.3f s, inputs %s)\n%s", callback, seconds, body.get("changedPropIds"), dump.getvalue())
+
+        return response
+
+    @server.route(path)
+    def metrics_endpoint():
+        return Response(render(), mimetype="text/plain; version=0.0.4")
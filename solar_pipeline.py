@@ -0,0 +1,117 @@
+import hashlib
+import inspect
+import marshal
+import os
+import pickle
+import tempfile
+import time
+
+import pandas as pd
+
+# Content-hashed cache of the stages of solar_process. The output of a stage is stored under a key hashing
+# its name, code, parameters and the keys of its inputs (contents of the source files or keys of previous
+# stages), so that a run only recomputes the stages downstream of what changed.
+
+cache_dir = os.environ.get("SOLAR_PIPELINE_CACHE_DIR", "pipeline_cache")
+
+runs = []  # Stages of the current run, reported by summary()
+
+
+def _artifact(key, load, status):
+    # Output of a stage, only loaded from the cache when a later stage needs to be recomputed
+    value = []
+
+    def get():
+        if not value:
+            value.append(load())
+        return value[0]
+
+    return {"key": key, "value": get, "status": status}
+
+
+def _path(name, key):
+    return os.path.join(cache_dir, name, f"{key}.pickle")
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def _write(path, value):
+    # Written to a temporary file then renamed, an interrupted run never leaves a partial entry
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(f.name, path)
+
+
+def _code(function):
+    try:
+        return inspect.getsource(function).encode()
+    except (OSError, TypeError):
+        return marshal.dumps(function.__code__)  # Functions defined in an interactive session
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def source(path, load):
+    # Input file of the pipeline, keyed by its content and only read if a stage using it is recomputed
+    start = time.perf_counter()
+    key = file_hash(path)
+    runs.append({"stage": path, "key": key[:12], "status": "source", "seconds": time.perf_counter() - start})
+
+    return _artifact(key, lambda: load(path), "source")
+
+
+def stage(name, function, inputs=(), parameters=None, modules=()):
+    # Output of function(*inputs, **parameters), reused from a previous run if none of its inputs, parameters
+    # or code changed. modules: modules called by the function, whose source is part of the key.
+    parameters = parameters or {}
+
+    digest = hashlib.sha256()
+    digest.update(name.encode())
+    digest.update(_code(function))
+    digest.update(repr(sorted(parameters.items())).encode())
+    for artifact in inputs:
+        digest.update(artifact["key"].encode())
+    for module in modules:
+        with open(module.__file__, 'rb') as f:
+            digest.update(f.read())
+    key = digest.hexdigest()
+
+    path = _path(name, key)
+    start = time.perf_counter()
+
+    if os.path.exists(path):
+        runs.append({"stage": name, "key": key[:12], "status": "reused", "seconds": time.perf_counter() - start})
+        return _artifact(key, lambda: _read(path), "reused")
+
+    value = function(*[artifact["value"]() for artifact in inputs], **parameters)
+    _write(path, value)
+
+    runs.append({"stage": name, "key": key[:12], "status": "computed", "seconds": time.perf_counter() - start})
+
+    return _artifact(key, lambda: value, "computed")
+
+
+def summary():
+    return pd.DataFrame(runs, columns=["stage", "key", "status", "seconds"]).set_index("stage")
+
+
+def prune():
+    # Remove the previous entries of the stages of the current run, keeping the ones just used
+    used = {(run["stage"], run["key"]) for run in runs if run["status"] != "source"}
+
+    for name in {name for name, _ in used}:
+        for entry in os.listdir(os.path.join(cache_dir, name)):
+            if (name, entry[:12]) not in used:
+                os.remove(os.path.join(cache_dir, name, entry))
@@ -3,158 +3,411 @@ from unicodedata import numeric
 import geopandas as gpd
 import pandas as pd
 import numpy as np
-import pickle
+import os
+import pyogrio
+import shapely
+
+import solar_artifacts
+import solar_forecast
+import solar_geometry
+import solar_hexbin
+import solar_pipeline
+import solar_regions
+
+# Each stage is stored in the pipeline cache (solar_pipeline) under a hash of its inputs, parameters and code:
+# a run only recomputes the stages downstream of the inputs that changed. The stages only run as a script
+# (python solar_process.py), the stage functions being imported by the benchmarks (solar_benchmark)
+
+if __name__ == '__main__':
+    communes = solar_pipeline.source("data/raw/communes.gpkg", gpd.read_file)
+    girec = solar_pipeline.source("data/raw/girec.gpkg", gpd.read_file)
+    pronovo_registry = solar_pipeline.source("data/raw/pronovo.gpkg", lambda path: path)  # Read by the ingestion stage
+
+    girec_potential = solar_pipeline.source(
+        "data/qbuildings/girec_potential.pickle",
+        lambda path: pd.read_pickle(path) / 1000  # Convert to MWc
+    )
 
-from statsmodels.tsa.holtwinters import ExponentialSmoothing
+years = list(range(2005, 2025))
+forecast_years = list(range(2025, 2051))
 
-communes = gpd.read_file("data/raw/communes.gpkg")
-girec = gpd.read_file("data/raw/girec.gpkg")
-pronovo = gpd.read_file("data/raw/pronovo.gpkg")
+# %% Read the installations of the canton from the national registry (pronovo)
 
-girec_potential = pd.read_pickle("data/qbuildings/girec_potential.pickle") / 1000  # Convert to MWc
+# Installations of the canton envelope read per call to the driver, bounding the memory of each read (the
+# chunks are then concatenated, so not that of the whole ingestion)
+pronovo_chunk_size = 100000
 
-# %% Create merged GeoDataFrame from pronovo, girec, and communes
+def read_pronovo(path, girec, chunk_size=None):
+    # Only the needed columns of the installations within the envelope of the canton, filtered at read time
+    # with the spatial index of the file, chunk by chunk (the chunks are offsets among the filtered installations),
+    # in one pass without chunk_size
+    info = pyogrio.read_info(path)
+    bbox = tuple(girec.to_crs(info['crs']).total_bounds)
 
-# spatial join between pronovo and girec to assign sub-municipality (girec)
-pronovo_girec = gpd.sjoin(pronovo, girec[['geometry', 'NOM', 'NO_COMM']], how="left", predicate='within')
+    chunks = []
+    while True:
+        chunk = gpd.read_file(
+            path,
+            columns=['TotalPower', 'BeginningOfOperation'],
+            bbox=bbox,
+            fid_as_index=True,  # Identity of the installations in the registry
+            skip_features=sum(len(chunk) for chunk in chunks),
+            max_features=chunk_size,
+        )
+        chunks.append(chunk)
 
-# join between pronovo_girec and communes to assign the municipality (commune)
-pronovo_girec_commune = pronovo_girec.merge(communes[['COMMUNE', 'NO_COMM']], on='NO_COMM', how='left')
+        if chunk_size is None or len(chunk) < chunk_size:
+            break
 
-# final GeoDataFrame with the required columns
-photovoltaic = pronovo_girec_commune[['TotalPower', 'BeginningOfOperation', 'NOM', 'COMMUNE', 'geometry']].copy()
-photovoltaic = photovoltaic.rename(columns={
-    'TotalPower': 'power',
-    'BeginningOfOperation': 'construction',
-    'NOM': 'girec',
-    'COMMUNE': 'commune'
-})
+    pronovo = gpd.GeoDataFrame(pd.concat(chunks), crs=info['crs']).to_crs(girec.crs)
 
-# %% Process data to get historical values (girec)
+    print(f"pronovo : {info['features']} installations in the registry, {len(pronovo)} kept in the canton envelope")
 
-# Convert 'construction' column to datetime format
-photovoltaic['construction'] = pd.to_datetime(photovoltaic['construction'])
+    return pronovo
 
-# Extract the year and convert 'power' column to numeric for aggregation
-photovoltaic['year'] = photovoltaic['construction'].dt.year
-photovoltaic['power'] = pd.to_numeric(photovoltaic['power'], errors='coerce') / 1000  # Convert to MWc
 
-# Group by 'girec' and 'year', and sum the power
-yearly_power = photovoltaic.groupby(['girec', 'year'])['power'].sum().reset_index()
+if __name__ == '__main__':
+    pronovo = solar_pipeline.stage(
+        "pronovo", read_pronovo, [pronovo_registry, girec], {"chunk_size": pronovo_chunk_size}
+    )
 
-# Pivot the table to have each year as a column
-pivot_power = yearly_power.pivot(index='girec', columns='year', values='power').fillna(0)
+# %% Create merged GeoDataFrame from pronovo, girec, and communes
 
-# Calculate the cumulative sum starting from year 2005 to 2024
-years = list(range(2005, 2024 + 1))
+# Installation -> girec assignment persisted between runs, keyed by installation identity and geometry
+assignment_path = os.path.join(solar_pipeline.cache_dir, "pronovo_assignment.pickle")
+
+def merge_photovoltaic(pronovo, girec, communes):
+    # assign sub-municipality (girec): only new or moved installations are resolved against the spatial index
+    # of the girecs, the others are taken from the previous runs (as long as the girecs did not change)
+    girec_hash = pd.util.hash_pandas_object(
+        pd.DataFrame({'NOM': girec['NOM'], 'NO_COMM': girec['NO_COMM'], 'geometry': shapely.to_wkb(girec.geometry.values)}),
+        index=False,
+    ).sum()
+    keys = pd.MultiIndex.from_arrays(
+        [pronovo.index, pd.util.hash_array(shapely.to_wkb(pronovo.geometry.values))], names=['fid', 'geometry_hash']
+    )
+
+    assignment = pd.DataFrame(
+        {'NOM': pd.Series(dtype=object), 'NO_COMM': pd.Series(dtype=float), 'edge': pd.Series(dtype=bool)}, index=keys[:0]
+    )
+    if os.path.exists(assignment_path):
+        previous = pd.read_pickle(assignment_path)
+        if previous['girec_hash'] == girec_hash:
+            assignment = previous['assignment']
+
+    new = ~keys.isin(assignment.index)
+    position, edge = solar_geometry.assign_points(pronovo.geometry.values[new], girec.geometry.values)
+    resolved = pd.DataFrame(
+        {
+            'NOM': girec['NOM'].iloc[np.maximum(position, 0)].where(position >= 0).to_numpy(),
+            'NO_COMM': girec['NO_COMM'].iloc[np.maximum(position, 0)].where(position >= 0).to_numpy(),
+            'edge': edge,
+        },
+        index=keys[new],
+    )
+
+    # installations removed from the registry are dropped from the table
+    assignment = pd.concat([assignment[assignment.index.isin(keys)], resolved])
+
+    os.makedirs(os.path.dirname(assignment_path), exist_ok=True)
+    pd.to_pickle({'girec_hash': girec_hash, 'assignment': assignment}, assignment_path)
+
+    print(f"assignment : {new.sum()} new or moved installations resolved, {(~new).sum()} reused, "
+          f"{assignment['edge'].sum()} on girec borders")
+
+    assigned = assignment.reindex(keys)
+    pronovo_girec = pronovo.assign(NOM=assigned['NOM'].to_numpy(), NO_COMM=assigned['NO_COMM'].to_numpy())
+
+    # join between pronovo_girec and communes to assign the municipality (commune)
+    pronovo_girec_commune = pronovo_girec.merge(communes[['COMMUNE', 'NO_COMM']], on='NO_COMM', how='left')
+
+    # final GeoDataFrame with the required columns
+    photovoltaic = pronovo_girec_commune[['TotalPower', 'BeginningOfOperation', 'NOM', 'COMMUNE', 'geometry']].copy()
+    photovoltaic = photovoltaic.rename(columns={
+        'TotalPower': 'power',
+        'BeginningOfOperation': 'construction',
+        'NOM': 'girec',
+        'COMMUNE': 'commune'
+    })
+
+    return photovoltaic
+
+
+if __name__ == '__main__':
+    photovoltaic = solar_pipeline.stage(
+        "photovoltaic", merge_photovoltaic, [pronovo, girec, communes], modules=[solar_geometry]
+    )
 
-# Add all years in the pivot table to ensure no missing years for cumulative calculation
-all_years = sorted(pivot_power.columns.union(years))
-pivot_power = pivot_power.reindex(columns=all_years, fill_value=0).cumsum(axis=1)
+# %% Process data to get historical values (girec)
 
-# Select only the cumulative sums for 2005 to 2024
-pivot_power = pivot_power[years]
+def historical_values(photovoltaic, girec, communes, years):
+    photovoltaic = photovoltaic.copy()
 
-# Join the cumulative power back to the 'girec' GeoDataFrame
-girec_historical = girec.merge(pivot_power, left_on='NOM', right_index=True, how='left')
+    # Convert 'construction' column to datetime format
+    photovoltaic['construction'] = pd.to_datetime(photovoltaic['construction'])
 
-# Replace missing values with 0 (if there are any sub-municipalities with no installations)
-girec_historical = girec_historical.fillna(0)
+    # Extract the year and convert 'power' column to numeric for aggregation
+    photovoltaic['year'] = photovoltaic['construction'].dt.year
+    photovoltaic['power'] = pd.to_numeric(photovoltaic['power'], errors='coerce') / 1000  # Convert to MWc
 
-# Replace the integer COMMUNE identifiers in girec_historical with the corresponding names
-commune_mapping = communes.set_index('NO_COMM')['COMMUNE'].to_dict()
-girec_historical['COMMUNE'] = girec_historical['NO_COMM'].map(commune_mapping)
+    # Group by 'girec' and 'year', and sum the power
+    yearly_power = photovoltaic.groupby(['girec', 'year'])['power'].sum().reset_index()
 
-# Set NOM as the index and keep only relevant columns
-girec_historical = girec_historical.set_index('NOM')
-girec_historical = girec_historical[['COMMUNE', 'geometry'] + [col for col in list(range(2005, 2024 + 1))]]
+    # Pivot the table to have each year as a column
+    pivot_power = yearly_power.pivot(index='girec', columns='year', values='power').fillna(0)
 
-# %% Forecasting future values with Holt’s Linear Trend Model (girec)
+    # Add all years in the pivot table to ensure no missing years for cumulative calculation
+    all_years = sorted(pivot_power.columns.union(years))
+    pivot_power = pivot_power.reindex(columns=all_years, fill_value=0).cumsum(axis=1)
 
-years = list(range(2005, 2025))
-forecast_years = list(range(2025, 2051))
+    # Select only the cumulative sums for the historical years
+    pivot_power = pivot_power[years]
 
-girec_forecast_lin = pd.DataFrame(index=girec_historical.index, columns=forecast_years)
+    # Join the cumulative power back to the 'girec' GeoDataFrame
+    girec_historical = girec.merge(pivot_power, left_on='NOM', right_index=True, how='left')
 
-# Loop through each girec
-for girec in girec_historical.index:
-    # Get historical data for the girec
-    girec_data = np.asarray(girec_historical.loc[girec, years])
+    # Replace missing values with 0 (if there are any sub-municipalities with no installations)
+    girec_historical = girec_historical.fillna(0)
 
-    # Fit Holt's Linear Model (trend only, no seasonality)
-    model = ExponentialSmoothing(girec_data, trend='add', seasonal=None)
-    fit = model.fit()
+    # Replace the integer COMMUNE identifiers in girec_historical with the corresponding names
+    commune_mapping = communes.set_index('NO_COMM')['COMMUNE'].to_dict()
+    girec_historical['COMMUNE'] = girec_historical['NO_COMM'].map(commune_mapping)
 
-    # Forecast for the next years
-    forecast = fit.forecast(len(forecast_years))
+    # Set NOM as the index and keep only relevant columns
+    girec_historical = girec_historical.set_index('NOM')
+    girec_historical = girec_historical[['COMMUNE', 'geometry'] + years]
 
-    # Save forecast in the result DataFrame
-    girec_forecast_lin.loc[girec, :] = forecast
+    return girec_historical
 
-girec_forecast_lin = girec_forecast_lin.astype(float)
 
-girec_lin = pd.concat([girec_historical, girec_forecast_lin, girec_potential], axis=1)
+if __name__ == '__main__':
+    girec_historical = solar_pipeline.stage(
+        "girec_historical", historical_values, [photovoltaic, girec, communes], {"years": years}
+    )
 
-# %% Forecasting future values with Exponential Trend Model (girec)
+# %% Forecasting future values with the registered models (girec)
 
-current_year = 2024
-target_capacity_2050 = 1000  # MWc
+# Worker processes fitting the models on chunks of girecs (None: one per CPU, 0: in process)
+forecast_workers = None
 
-girec_forecast_exp = pd.DataFrame(index=girec_historical.index, columns=forecast_years)
+# Holt's linear trend (the batch fit can be checked against statsmodels with solar_forecast.compare_with_statsmodels),
+# damped trend, exponential growth to the 2050 target and logistic growth saturating at the potential.
+# Each model is a stage, only those reading the potential depending on it.
 
-# Sum of the PV capacities for each girec in 2024 (used as y_0)
-y_0_total = girec_historical[2024].sum()
+def forecast(girec_historical, girec_potential=None, name=None, years=None, forecast_years=None):
+    if girec_potential is None:
+        potential = np.full(len(girec_historical), np.nan)
+    else:
+        potential = girec_potential['pv_potential'].reindex(girec_historical.index).to_numpy(dtype=float)
 
-# Determine the required growth rate to reach 1000 MWc by 2050
-# r = ln(target / y_0) / (forecast_year - current_year)
-r_target = np.log(target_capacity_2050 / y_0_total) / (2050 - current_year)
+    forecasts, timings = solar_forecast.run_models(
+        girec_historical[years].to_numpy(dtype=float),
+        potential,
+        len(forecast_years),
+        names=[name],
+        workers=forecast_workers,
+    )
 
-# Forecast capacity for each municipality with exponential growth
-for girec in girec_historical.index:
-    # y_0 for the girec (capacity at the end of 2024)
-    y_0_girec = girec_historical.loc[girec, 2024]
+    return pd.DataFrame(forecasts[name], index=girec_historical.index, columns=forecast_years), timings
 
-    # Generate forecasts using the adjusted growth rate
-    forecast_values = [y_0_girec * np.exp(r_target * (year - current_year)) for year in forecast_years]
 
-    # Store results in the forecast DataFrame
-    girec_forecast_exp.loc[girec, :] = forecast_values
+def girec_model(girec_historical, girec_forecast, girec_potential):
+    return pd.concat([girec_historical, girec_forecast[0], girec_potential], axis=1)
 
-girec_forecast_exp = girec_forecast_exp.astype(float)
-girec_exp = pd.concat([girec_historical, girec_forecast_exp, girec_potential], axis=1)
 
-# %% Forecasting future values for communes from girec aggregation
-communes_lin = girec_lin.dissolve(by='COMMUNE', aggfunc='sum')
-communes_lin = communes_lin.reset_index().set_index('COMMUNE')
-communes_lin = communes_lin[['geometry'] + [col for col in list(range(2005, 2050 + 1))] + ['pv_potential']]
+if __name__ == '__main__':
+    girec_models = {}
+    for name in solar_forecast.models:
+        inputs = [girec_historical, girec_potential] if solar_forecast.models[name]["potential"] else [girec_historical]
+        girec_forecast = solar_pipeline.stage(
+            f"forecast_{name}", forecast, inputs,
+            {"name": name, "years": years, "forecast_years": forecast_years}, modules=[solar_forecast],
+        )
 
-communes_exp = girec_exp.dissolve(by='COMMUNE', aggfunc='sum')
-communes_exp = communes_exp.reset_index().set_index('COMMUNE')
-communes_exp = communes_exp[['geometry'] + [col for col in list(range(2005, 2050 + 1))] + ['pv_potential']]
+        if girec_forecast["status"] == "computed":
+            print(girec_forecast["value"]()[1])
 
-# %% Save the processed data to pickle files
+        girec_models[name] = solar_pipeline.stage(f"girec_{name}", girec_model, [girec_historical, girec_forecast, girec_potential])
 
-output = {
-    'girec_lin': girec_lin,
-    'communes_lin': communes_lin,
-    'girec_exp': girec_exp,
-    'communes_exp': communes_exp
-}
+# %% Save the processed data to columnar artifacts (solar_artifacts)
 
-for key, value in output.items():
+def output_frame(value):
     value = value.fillna(0)
     value = value.round(2)
     value = value.set_crs("EPSG:2056").to_crs("EPSG:4326")
 
-    f = open(f"output/{key}.pickle", 'wb')
-    pickle.dump(value, f)
-    f.close()
+    return value
+
+
+# Communes and other regions are aggregated from the girecs by the app (solar_regions), only their geometry
+# and membership are stored
+if __name__ == '__main__':
+    output = {}
+    for name in girec_models:
+        output[f'girec_{name}'] = solar_pipeline.stage(f"output_girec_{name}", output_frame, [girec_models[name]])
+
+    for key, value in output.items():
+        solar_artifacts.write(key, value["value"]())
+
+# %% Simplified geometry levels for the map (shared borders are kept shared)
+
+# Geometry of the girecs and their commune, the levels are not recomputed when only the values change
+def unit_geometry(girec, communes):
+    commune_mapping = communes.set_index('NO_COMM')['COMMUNE'].to_dict()
+
+    return girec.assign(COMMUNE=girec['NO_COMM'].map(commune_mapping)).set_index('NOM')[['COMMUNE', 'geometry']]
+
+
+def levels(geometry):
+    return solar_geometry.build_levels(geometry.geometry.set_crs("EPSG:2056"))
+
+
+if __name__ == '__main__':
+    geometry = solar_pipeline.stage("geometry", unit_geometry, [girec, communes])
+    girec_levels = solar_pipeline.stage("levels_girec", levels, [geometry], modules=[solar_geometry])
+    solar_geometry.write_levels("girec", girec_levels["value"]())
+
+    print("girec")
+    print(solar_geometry.levels_report(girec_levels["value"]()))
+
+# %% Region sets: membership of the girecs and dissolved geometry levels of the communes and custom regions
+
+def communes_region_set(geometry, girec_levels):
+    membership = solar_regions.assignment_membership(geometry['COMMUNE'])
+    levels = {tolerance: solar_regions.dissolve(value, membership) for tolerance, value in girec_levels.items()}
+
+    return membership, {tolerance: value.rename_axis('COMMUNE') for tolerance, value in levels.items()}
+
+
+def custom_region_set(path, geometry, girec_levels):
+    return solar_regions.region_set(path, geometry.set_crs("EPSG:2056"), girec_levels)
+
+
+if __name__ == '__main__':
+    region_sets = {
+        'communes': solar_pipeline.stage(
+            "regions_communes", communes_region_set, [geometry, girec_levels], modules=[solar_regions, solar_geometry]
+        )
+    }
+    for name, path in solar_regions.region_files().items():
+        region_file = solar_pipeline.source(path, lambda path: path)
+        region_sets[name] = solar_pipeline.stage(
+            f"regions_{name}", custom_region_set, [region_file, geometry, girec_levels], modules=[solar_regions, solar_geometry]
+        )
+
+def region_memberships(*region_sets, names=None):
+    return pd.concat(
+        [membership.assign(region_set=name) for name, (membership, _) in zip(names, region_sets)], ignore_index=True
+    )
+
+
+if __name__ == '__main__':
+    memberships = solar_pipeline.stage(
+        "memberships", region_memberships, list(region_sets.values()), {"names": list(region_sets)}
+    )
+    solar_artifacts.write("regions", memberships["value"]())
+
+    for name, region_set in region_sets.items():
+        region_levels = region_set["value"]()[1]
+
+        solar_artifacts.write(solar_regions.artifact(name), gpd.GeoDataFrame(geometry=region_levels[0]))
+        solar_geometry.write_levels(solar_regions.artifact(name), region_levels)
+
+        print(name)
+        print(solar_geometry.levels_report(region_levels))
+
+# %% Installation density on hexagonal grids, the installations being kept as points (capacity and date)
+
+def installation_points(photovoltaic):
+    photovoltaic = photovoltaic.assign(
+        date=pd.to_datetime(photovoltaic['construction']),
+        power=pd.to_numeric(photovoltaic['power'], errors='coerce') / 1000,  # Convert to MWc
+    )
+    photovoltaic = photovoltaic.dropna(subset=['girec', 'date', 'power'])
+
+    # Sorted by girec and commissioning date, the index of the capacity timeline (solar_timeline)
+    photovoltaic = photovoltaic.sort_values(['girec', 'date'], kind='stable')
+
+    return pd.DataFrame({
+        'x': photovoltaic.geometry.x.to_numpy(),
+        'y': photovoltaic.geometry.y.to_numpy(),
+        'date': photovoltaic['date'].to_numpy(),
+        'year': photovoltaic['date'].dt.year.to_numpy(),
+        'power': photovoltaic['power'].to_numpy(),
+        'girec': photovoltaic['girec'].to_numpy(),
+    })
+
+
+def hexbin(installations, geometry, size=None, years=None):
+    return solar_hexbin.hexbin(installations, geometry.geometry.set_crs("EPSG:2056"), size, years)
+
+
+if __name__ == '__main__':
+    installations = solar_pipeline.stage("installations", installation_points, [photovoltaic])
+    solar_artifacts.write("installations", installations["value"]())
+
+    for size in solar_hexbin.sizes.values():
+        grid = solar_pipeline.stage(
+            f"hexbin_{size}", hexbin, [installations, geometry], {"size": size, "years": years},
+            modules=[solar_hexbin, solar_regions],
+        )
+        solar_hexbin.write(size, *grid["value"]())
+
+        print(f"hexbin_{size} : {len(grid['value']()[0])} cells")
+
+# %% Prediction intervals (P10/P50/P90) of the models simulating paths, for the girecs, region sets and canton
+
+def bands(girec_historical, memberships, girec_potential=None, name=None, years=None, forecast_years=None):
+    units = girec_historical.index
+    if girec_potential is None:
+        potential = np.full(len(units), np.nan)
+    else:
+        potential = girec_potential['pv_potential'].reindex(units).to_numpy(dtype=float)
 
+    # Regions of each granularity, their bands being computed from the summed paths of their girecs
+    regions = {'canton': pd.Index(['Canton'])}
+    aggregations = {'canton': solar_regions.canton(units)}
+    for region_set, membership in memberships.groupby('region_set', sort=False):
+        regions[region_set] = pd.Index(membership['region'].unique())
+        aggregations[region_set] = solar_regions.matrix(membership, units, regions[region_set])
+
+    model_bands = solar_forecast.forecast_bands(
+        name, girec_historical[years].to_numpy(dtype=float), potential, len(forecast_years), aggregations
+    )
+    regions['girec'] = units
+    model_bands['girec'] = model_bands.pop('units')
+
+    # One row per granularity, unit and year, one column per percentile
+    frames = []
+    for granularity, values in model_bands.items():
+        frame = pd.DataFrame(
+            values.transpose(0, 2, 1).reshape(-1, len(solar_forecast.band_percentiles)),
+            index=pd.MultiIndex.from_product([regions[granularity].astype(str), forecast_years], names=['unit', 'year']),
+            columns=[f'p{percentile}' for percentile in solar_forecast.band_percentiles],
+        )
+        frames.append(frame.reset_index().assign(granularity=granularity))
+
+    return pd.concat(frames, ignore_index=True).round(2)
+
+
+if __name__ == '__main__':
+    for name in solar_forecast.models:
+        if solar_forecast.models[name]["simulate"] is None:
+            continue
+
+        inputs = [girec_historical, memberships] + ([girec_potential] if solar_forecast.models[name]["potential"] else [])
+        model_bands = solar_pipeline.stage(
+            f"bands_{name}", bands, inputs,
+            {"name": name, "years": years, "forecast_years": forecast_years}, modules=[solar_forecast, solar_regions],
+        )
+        solar_artifacts.write(f"bands_{name}", model_bands["value"]())
 
 # %% Print some results
 
-lin_2050 = communes_lin[2050].sum()
-exp_2050 = communes_exp[2050].sum()
+if __name__ == '__main__':
+    for name, layer in girec_models.items():
+        print(f"{name}_2050 : ", layer["value"]()[2050].sum())
 
-print("lin_2050 : ", lin_2050)
-print("exp_2050 : ", exp_2050)
+    # Stages reused from previous runs, previous entries of the stages are removed
+    print(solar_pipeline.summary())
+    solar_pipeline.prune()
@@ -0,0 +1,151 @@
+import glob
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from scipy import sparse
+
+import solar_artifacts
+import solar_geometry
+
+# Regions (communes, custom region sets, the whole canton) derived from the girecs with a sparse membership
+# matrix (regions x girecs), the weight of a girec being its share in the region. Any aggregation of the girec
+# values is a single matrix product: the regions are stored as their geometry and membership only.
+
+# Custom region sets, one per file: CSV assigning girecs to regions (columns NOM and region) or polygons drawn
+# in a GIS (GeoJSON or GeoPackage with a region column), the girecs being split between the polygons by area
+regions_dir = os.environ.get("SOLAR_REGIONS_DIR", "data/regions")
+
+# Granularities of the app and bands that are not custom region sets (the hexbin grids being hexbin_<size>)
+reserved_names = ["girec", "communes", "canton", "hexbin"]
+
+
+def region_files():
+    # Custom region sets {name: path}, named after their file, files named after another granularity left out
+    paths = sorted(glob.glob(os.path.join(regions_dir, "*.csv")) + glob.glob(os.path.join(regions_dir, "*.geojson"))
+                   + glob.glob(os.path.join(regions_dir, "*.gpkg")))
+
+    files = {}
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        if name in reserved_names or name.startswith("hexbin_"):
+            print(f"{path} skipped, {name} is the name of another granularity")
+            continue
+
+        files[name] = path
+
+    return files
+
+
+def artifact(name):
+    # Artifact of the geometry of a region set (and of its levels), prefixed not to overwrite the other artifacts
+    # (e.g. a region file named girec_lin.csv or regions.csv)
+    return f"region_{name}"
+
+
+def assignment_membership(assignment):
+    # Membership triplets of a girec -> region assignment (Series indexed by girec), girecs without region left out
+    assignment = assignment.dropna()
+
+    return pd.DataFrame({"unit": assignment.index.to_numpy(), "region": assignment.to_numpy(), "weight": 1.0})
+
+
+def area_membership(units, regions):
+    # Share of the area of each girec within each region polygon (GeoSeries in the same projected CRS,
+    # regions indexed by name)
+    region_idx, unit_idx = shapely.STRtree(np.asarray(units.values)).query(np.asarray(regions.values), predicate="intersects")
+    overlap = shapely.area(shapely.intersection(units.values[unit_idx], regions.values[region_idx]))
+    weight = overlap / shapely.area(units.values[unit_idx])
+
+    membership = pd.DataFrame({"unit": units.index[unit_idx], "region": regions.index[region_idx], "weight": weight})
+
+    return membership[membership["weight"] > 1e-6].reset_index(drop=True)
+
+
+def matrix(membership, units, regions):
+    # Sparse membership matrix (regions x units) of the triplets, for the given order of units and regions
+    rows = regions.get_indexer(membership["region"])
+    columns = units.get_indexer(membership["unit"])
+    keep = (rows >= 0) & (columns >= 0)
+
+    return sparse.csr_matrix(
+        (membership["weight"].to_numpy(dtype=float)[keep], (rows[keep], columns[keep])), shape=(len(regions), len(units))
+    )
+
+
+def canton(units):
+    # Membership of every unit in the canton
+    return sparse.csr_matrix(np.ones((1, len(units))))
+
+
+def aggregate(matrix, values):
+    # Values of the regions from those of the units, units being the last axis of values
+    flat = np.asarray(values, dtype=float).reshape(-1, values.shape[-1])
+
+    return np.asarray(matrix @ flat.T).T.reshape(values.shape[:-1] + (matrix.shape[0],))
+
+
+def dissolve(geometry, membership):
+    # Geometry of the regions of an assignment as the union of their girecs. Applied to the simplified girec
+    # levels, the borders of the regions stay shared as those of the girecs.
+    region = pd.Series(membership["region"].to_numpy(), index=membership["unit"])
+    units = geometry[geometry.index.isin(region.index)]
+
+    dissolved = units.groupby(region.reindex(units.index).to_numpy()).agg(shapely.union_all)
+
+    return gpd.GeoSeries(dissolved, crs=geometry.crs).rename_axis("region")
+
+
+def region_set(path, girec, girec_levels):
+    # Membership and geometry levels of a custom region set (girec: GeoDataFrame of the girecs, indexed by NOM)
+    if path.endswith(".csv"):
+        assignment = pd.read_csv(path, index_col="NOM")["region"]
+        membership = assignment_membership(assignment)
+        levels = {tolerance: dissolve(geometry, membership) for tolerance, geometry in girec_levels.items()}
+    else:
+        regions = gpd.read_file(path).set_index("region").geometry.to_crs(girec.crs)
+        membership = area_membership(girec.geometry, regions)
+        levels = solar_geometry.build_levels(regions)
+
+    return membership, levels
+
+
+def load(units):
+    # Region sets written by the pipeline {name: (membership matrix, index of the regions)}, in order of appearance
+    membership = solar_artifacts.read("regions")
+    sets = {}
+
+    for name, triplets in membership.groupby("region_set", sort=False):
+        regions = solar_artifacts.read(artifact(name), columns=[]).index
+        sets[name] = (matrix(triplets, units, regions), regions)
+
+    return sets
+
+
+def write_communes(layer="girec_lin"):
+    # Communes region set (membership, geometry and levels) from the girec layer of existing outputs, without
+    # rerunning the whole pipeline
+    girec = solar_artifacts.read(layer, columns=["COMMUNE", "geometry"])
+
+    # Outputs of the versions of the pipeline that did not simplify the geometry
+    if not solar_artifacts.exists("girec_levels"):
+        solar_geometry.save_levels("girec", girec.geometry)
+
+    girec_levels = solar_geometry.load_levels("girec", girec.geometry)
+
+    membership = assignment_membership(girec["COMMUNE"])
+    levels = {
+        tolerance: dissolve(geometry, membership).rename_axis("COMMUNE") for tolerance, geometry in girec_levels.items()
+    }
+
+    solar_artifacts.write("regions", membership.assign(region_set="communes"))
+    solar_artifacts.write(artifact("communes"), gpd.GeoDataFrame(geometry=levels[0]))
+    solar_geometry.write_levels(artifact("communes"), levels)
+
+    return levels
+
+
+if __name__ == '__main__':
+    print(solar_geometry.levels_report(write_communes()))
@@ -0,0 +1,180 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import plotly.io
+import plotly.offline
+
+import solar_app
+import solar_cube
+import solar_geometry
+
+# Static snapshots of every state of the map and plots of the app (granularity x model x metric x year), built
+# with the figure functions of the callbacks without starting the server. The figures are rendered on a pool
+# of forked workers sharing the geometry loaded by the app, and those whose inputs did not change since the
+# previous run (values, geometry and code, recorded in the manifest of the output directory) are skipped.
+#
+#   python solar_render.py --output render --format html json
+#   python solar_render.py --granularities communes --models exp --years 2030 2050
+
+manifest_name = "manifest.json"
+
+
+def code_version():
+    # Hash of the code and assets building the figures
+    digest = hashlib.sha256()
+
+    for path in sorted(["solar_app.py", "solar_cube.py", "solar_geometry.py", "solar_hexbin.py", "solar_render.py", "assets/style.css"]):
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+
+    return digest.hexdigest()
+
+
+def input_key(*parts):
+    # Hash of the inputs of a figure: parameters, arrays of values and versions
+    digest = hashlib.sha256()
+
+    for part in parts:
+        digest.update(part.tobytes() if hasattr(part, "tobytes") else repr(part).encode())
+
+    return digest.hexdigest()[:16]
+
+
+def tasks(granularities, models, metrics, years, potential_scaling, level, versions):
+    # Figures of the grid {name: (kind, parameters, key)}, the plots not depending on the metric
+    grid = {}
+
+    for granularity in granularities:
+        # Units drawn at the level (the cells of the installation density depend on it)
+        drawn = solar_app.drawn_granularity(granularity, level)
+        tolerance = max(tolerance for tolerance in solar_app.levels[drawn] if tolerance <= level)
+
+        for model in models:
+            totals = solar_cube.totals(solar_app.cube, drawn, model).to_numpy()
+
+            for year in years:
+                for metric in metrics:
+                    values = solar_cube.lookup(solar_app.cube, drawn, model, potential_scaling, metric, year)
+                    parameters = (year, granularity, metric, model, potential_scaling, level)
+                    grid[f"map_{granularity}_{model}_{metric}_{year}"] = (
+                        "map", parameters, input_key(parameters, values, versions[drawn, tolerance]),
+                    )
+
+                power = solar_cube.lookup(solar_app.cube, drawn, model, solar_cube.potential_scalings[0], "power", year)
+                parameters = (year, granularity, model, None, None, level)
+                grid[f"plots_{granularity}_{model}_{year}"] = ("plots", parameters, input_key(parameters, power, totals, versions["code"]))
+
+    return grid
+
+
+def render(name, kind, parameters, directory, formats):
+    # Figure of a task written in each format, returns the number of figures rendered
+    if kind == "map":
+        year, granularity, metric, model, potential_scaling, level = parameters
+        figure, _ = solar_app.update_map(year, granularity, True, metric, model, potential_scaling, None, None, level=level)
+        figures = {name: figure}
+    else:
+        expansion, share = solar_app.update_plots(*parameters)
+        figures = {f"{name}_expansion": expansion, f"{name}_share": share}
+
+    for figure_name, figure in figures.items():
+        if "json" in formats:
+            with open(os.path.join(directory, f"{figure_name}.json"), 'w') as f:
+                f.write(plotly.io.to_json(figure, validate=False))
+
+        if "html" in formats:
+            # plotly.js is written once in the directory, each page referencing it
+            with open(os.path.join(directory, f"{figure_name}.html"), 'w') as f:
+                f.write(plotly.io.to_html(figure, include_plotlyjs="directory", validate=False))
+
+    return len(figures)
+
+
+def _render_chunk(chunk, directory, formats):
+    return sum(render(name, kind, parameters, directory, formats) for name, kind, parameters in chunk)
+
+
+def render_all(directory, grid, formats, workers=None, chunk_size=20, force=False):
+    # Render the figures of the grid whose inputs changed, on a pool of forked workers (in process with workers=0)
+    os.makedirs(directory, exist_ok=True)
+
+    manifest_path = os.path.join(directory, manifest_name)
+    manifest = {}
+    if os.path.exists(manifest_path) and not force:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    formats = sorted(formats)
+    todo = [
+        (name, kind, parameters) for name, (kind, parameters, key) in grid.items()
+        if manifest.get(name) != [key, formats]
+    ]
+
+    if "html" in formats:
+        with open(os.path.join(directory, "plotly.min.js"), 'w') as f:
+            f.write(plotly.offline.get_plotlyjs())
+
+    # The base map of each granularity is built before forking, the workers inheriting it from the figure cache
+    for granularity, level in {(parameters[1], parameters[5]) for _, kind, parameters in todo if kind == "map"}:
+        drawn = solar_app.drawn_granularity(granularity, level)
+        solar_app.base_map_figure(drawn, True, max(tolerance for tolerance in solar_app.levels[drawn] if tolerance <= level))
+
+    chunks = [todo[i:i + chunk_size] for i in range(0, len(todo), chunk_size)]
+    start = time.perf_counter()
+
+    if workers == 0 or "fork" not in multiprocessing.get_all_start_methods():
+        rendered = sum(_render_chunk(chunk, directory, formats) for chunk in chunks)
+    else:
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), mp_context=multiprocessing.get_context("fork")) as pool:
+            rendered = sum(pool.map(_render_chunk, chunks, [directory] * len(chunks), [formats] * len(chunks)))
+
+    seconds = time.perf_counter() - start
+
+    manifest.update({name: [key, formats] for name, (_, _, key) in grid.items()})
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+    rendered_names = {name for name, _, _ in todo}
+    skipped = sum(1 if kind == "map" else 2 for name, (kind, _, _) in grid.items() if name not in rendered_names)
+
+    return {"rendered": rendered, "skipped": skipped, "seconds": seconds}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Static snapshots of the maps and plots of the solar app")
+    parser.add_argument("--output", default="render", help="Directory the figures are written to")
+    parser.add_argument("--format", nargs="+", choices=["html", "json"], default=["html", "json"], help="Formats of the figures")
+    parser.add_argument("--granularities", nargs="+", default=list(solar_app.granularity_labels), help="Granularities rendered")
+    parser.add_argument("--models", nargs="+", default=solar_app.models, help="Forecast models rendered")
+    parser.add_argument("--metrics", nargs="+", default=solar_cube.metrics, help="Metrics of the maps rendered")
+    parser.add_argument("--years", nargs="+", type=int, default=solar_cube.years, help="Years rendered")
+    parser.add_argument("--potential", type=int, choices=solar_cube.potential_scalings, default=solar_cube.potential_scalings[0],
+                        help="Scaling of the potential")
+    parser.add_argument("--level", type=int, default=solar_geometry.level_for_zoom(solar_geometry.tolerances, solar_app.map_zoom),
+                        help="Simplification tolerance of the geometry [m], that of the initial zoom by default")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (one per CPU by default, 0: in process)")
+    parser.add_argument("--force", action="store_true", help="Render all the figures, even those that did not change")
+    args = parser.parse_args(argv)
+
+    versions = {"code": code_version()}
+    for granularity in {solar_app.drawn_granularity(granularity, args.level) for granularity in args.granularities}:
+        for tolerance, geojson in solar_app.geojson[granularity].items():
+            versions[granularity, tolerance] = input_key(versions["code"], json.dumps(geojson))
+
+    grid = tasks(args.granularities, args.models, args.metrics, args.years, args.potential, args.level, versions)
+    result = render_all(args.output, grid, args.format, workers=args.workers, force=args.force)
+
+    print(f"{result['rendered']} figures rendered in {result['seconds']:.1f} s "
+          f"({result['rendered'] / max(result['seconds'], 1e-9):.1f} figures/s), {result['skipped']} unchanged skipped")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+
+# Installed capacity at any date from an index of the commissioning dates: the installations sorted by unit then
+# date, with the prefix sums of their power. The search key of an installation combines the position of its
+# unit and its date, so that the capacity of every unit as of a date is a single binary search over the whole
+# index, without storing any dense date x unit matrix.
+
+
+def build(units, unit, date, power):
+    # units: Index of the units, unit: unit of each installation (those of other units are left out),
+    # date: commissioning date and power of each installation
+    position = units.get_indexer(np.asarray(unit))
+    keep = position >= 0
+
+    days = np.asarray(date, dtype="datetime64[D]").astype(np.int64)[keep]
+    origin = days.min() if len(days) else 0
+
+    # Keys of a unit lie within [position * span, (position + 1) * span - 2], whatever the date searched
+    span = (days.max() - origin + 2) if len(days) else 2
+    keys = position[keep] * span + (days - origin)
+    order = np.argsort(keys, kind="stable")
+
+    return {
+        "units": units,
+        "origin": origin,
+        "span": span,
+        "keys": keys[order],
+        "cumulative": np.concatenate([[0], np.cumsum(np.asarray(power, dtype=float)[keep][order])]),
+        # First installation of each unit
+        "starts": np.searchsorted(keys[order], np.arange(len(units)) * span, side="left"),
+    }
+
+
+def capacity_at(timeline, dates, membership=None):
+    # Capacity of every unit commissioned up to each date (included), (units,) for a date or (units x dates),
+    # that of sets of units with their membership matrix (sets x units, e.g. solar_regions)
+    days = np.asarray(dates, dtype="datetime64[D]").astype(np.int64) - timeline["origin"]
+    days = np.clip(days, -1, timeline["span"] - 1)
+
+    unit_keys = np.arange(len(timeline["units"])) * timeline["span"]
+    ends = np.searchsorted(timeline["keys"], unit_keys.reshape((-1,) + (1,) * days.ndim) + days, side="right")
+
+    capacity = timeline["cumulative"][ends] - timeline["cumulative"][timeline["starts"]].reshape(ends.shape[:1] + (1,) * days.ndim)
+
+    return capacity if membership is None else np.asarray(membership @ capacity)
+
+
+def month_end(year, month):
+    return pd.Timestamp(year=year, month=month, day=1) + pd.offsets.MonthEnd(0)
+
+
+def monthly(timeline, start, end, membership=None):
+    # Cumulative capacity at the end of every month from start to end (months x units or sets of units)
+    months = pd.date_range(start, end, freq="ME")
+    capacity = capacity_at(timeline, months.to_numpy(), membership)
+
+    return pd.DataFrame(capacity.T, index=months, columns=None if membership is not None else timeline["units"])